@@ -0,0 +1,62 @@
+"""
+Cálculo del tiempo en el aire (time-on-air) de una trama LoRa.
+
+Es la misma fórmula que ``SX126X.getTimeOnAir`` del firmware de los nodos
+(``uPython/*/sx126x.py``), para que la API y la radio coincidan en el coste
+de cada trama.
+"""
+import json
+
+# Nombre con el que el puente reenvía los mensajes de bajada (Node-XXXXXX)
+BRIDGE_NODE_NAME = "Node-000000"
+
+
+def time_on_air(length, sf, bw_khz, cr, preamble=8, crc=True, explicit_header=True):
+    """
+    Devuelve el tiempo en el aire de una trama LoRa en microsegundos.
+    :param length: Longitud de la carga útil en bytes
+    :param sf: Spreading factor (5-12)
+    :param bw_khz: Ancho de banda en kHz
+    :param cr: Coding rate como denominador de 4/x (5-8)
+    :param preamble: Longitud del preámbulo en símbolos
+    :param crc: CRC de carga útil activado
+    :param explicit_header: Cabecera explícita
+    :return:
+    """
+    symbol_us = int(((1000 * 10) << sf) / (bw_khz * 10))
+    sf_coeff1_x4 = 17
+    sf_coeff2 = 8
+    if sf == 5 or sf == 6:
+        sf_coeff1_x4 = 25
+        sf_coeff2 = 0
+    sf_divisor = 4 * sf
+    if symbol_us >= 16000:
+        # Optimización para tasa de datos baja
+        sf_divisor = 4 * (sf - 2)
+    bits_per_crc = 16
+    n_symbol_header = 20 if explicit_header else 0
+
+    bit_count = int(8 * length + int(crc) * bits_per_crc - 4 * sf + sf_coeff2 + n_symbol_header)
+    if bit_count < 0:
+        bit_count = 0
+
+    n_pre_coded_symbols = int((bit_count + (sf_divisor - 1)) / sf_divisor)
+    n_symbol_x4 = int((preamble + 8) * 4 + sf_coeff1_x4 + n_pre_coded_symbols * cr * 4)
+
+    return int((symbol_us * n_symbol_x4) / 4)
+
+
+def downlink_frame_length(message, dl=None):
+    """
+    Longitud de la trama que el puente transmite para un mensaje de bajada:
+    ``{"from": "Node-XXXXXX", "message": ..., "dl": ...}`` seguido de un
+    salto de línea.
+    :param message:
+    :param dl: Identificador del mensaje de bajada, o None si no lleva
+    :return:
+    """
+    frame = {"from": BRIDGE_NODE_NAME, "message": message}
+    if dl is not None:
+        frame["dl"] = dl
+    pkt = json.dumps(frame, ensure_ascii=False)
+    return len(pkt.encode()) + 1
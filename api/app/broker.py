@@ -0,0 +1,406 @@
+"""
+Clientes MQTT de la API.
+
+Hay dos modos con la misma interfaz:
+
+- ``thread``: paho con su hilo de red (``loop_start``). Cada mensaje recibido
+  llega en el hilo de paho.
+- ``asyncio``: aiomqtt, que atiende el socket de paho desde el propio event
+  loop de FastAPI. La ingesta no cambia de hilo.
+
+En ambos modos ``publish`` es una corrutina que termina cuando el broker
+confirma la publicación (PUBACK en QoS 1).
+
+``start`` no espera al broker: la conexión se establece en segundo plano y,
+si se cae, se reintenta con esperas exponenciales con jitter. ``ready``
+indica si el cliente está conectado y con todas sus suscripciones activas.
+"""
+import asyncio
+import logging
+import random
+
+import aiomqtt
+from paho.mqtt import client as mqtt_client
+
+logger = logging.getLogger(__name__)
+
+MODE_THREAD = "thread"
+MODE_ASYNCIO = "asyncio"
+
+
+class Backoff:
+    """
+    Esperas entre intentos de conexión: exponenciales y con jitter completo
+    (un valor al azar entre 0 y el tope del intento), para que varios
+    workers o instancias no reconecten todos a la vez tras una caída del
+    broker.
+    """
+
+    def __init__(self, base=0.5, cap=30.0):
+        """
+        :param base: Tope de la primera espera, en segundos
+        :param cap: Tope máximo de cualquier espera, en segundos
+        """
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next(self):
+        """
+        Espera antes del siguiente intento.
+        :return: Segundos
+        """
+        delay = random.uniform(0, min(self.cap, self.base * 2 ** self.attempt))
+        self.attempt = min(self.attempt + 1, 32)
+        return delay
+
+    def reset(self):
+        """
+        Vuelve a la espera inicial tras una conexión correcta.
+        :return:
+        """
+        self.attempt = 0
+
+
+class ThreadedBroker:
+    """
+    Cliente paho con hilo de red propio.
+
+    Cada conexión usa un cliente paho nuevo, como ``AsyncBroker``: paho
+    guarda las publicaciones QoS 1 sin confirmar y las reenvía al reconectar
+    el mismo cliente, y esas publicaciones ya se han dado por fallidas.
+    """
+
+    def __init__(self, host, port, topics, handler, inflight=20, backoff=None):
+        """
+        :param host:
+        :param port:
+        :param topics: Topics a los que suscribirse
+        :param handler: ``handler(topic, payload)``, llamado en el hilo de paho
+        :param inflight: Máximo de publicaciones QoS 1 sin confirmar
+        :param backoff: Backoff de los reintentos de conexión
+        """
+        self.host = host
+        self.port = port
+        self.topics = topics
+        self.handler = handler
+        self.inflight = inflight
+        self.backoff = backoff or Backoff()
+        self.loop = None
+        self.connected = False
+        self.ready = False
+        self._pending = {}             # mid -> futuro de publish; solo se toca en el event loop
+        self._lost = None
+        self._task = None
+        self.client = self._new_client()
+
+    def _new_client(self):
+        # Las reconexiones las gestiona _supervise, no el hilo de paho
+        client = mqtt_client.Client(mqtt_client.CallbackAPIVersion.VERSION2, reconnect_on_failure=False)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_subscribe = self._on_subscribe
+        client.on_message = self._on_message
+        client.on_publish = self._on_publish
+        client.max_inflight_messages_set(self.inflight)
+        return client
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        """
+        Callback de conexión MQTT. Se llama cuando el cliente se conecta al broker.
+        :return:
+        """
+        if reason_code.is_failure:
+            logger.error(f"MQTT broker refused the connection: {reason_code}")
+            self.loop.call_soon_threadsafe(self._lost.set)
+            return
+        self.connected = True
+        client.subscribe([(topic, 0) for topic in self.topics])
+
+    def _on_subscribe(self, client, userdata, mid, reason_codes, properties):
+        """
+        Callback de confirmación de la suscripción.
+        :return:
+        """
+        failed = [t for t, rc in zip(self.topics, reason_codes) if rc.is_failure]
+        if failed:
+            logger.error(f"MQTT subscription refused for: {', '.join(failed)}")
+            return
+        self.ready = True
+        self.backoff.reset()
+        logger.info(f"MQTT connected to {self.host}:{self.port} and subscribed")
+
+    def _on_disconnect(self, client, userdata, flags, reason_code, properties):
+        """
+        Callback de desconexión. Avisa a ``_supervise`` para que reconecte.
+        :return:
+        """
+        self.connected = False
+        self.ready = False
+        if self._lost is not None:
+            self.loop.call_soon_threadsafe(self._lost.set)
+
+    def _on_message(self, client, userdata, msg):
+        """
+        Callback de mensaje MQTT. Se llama cuando se recibe un mensaje en un
+        topic suscrito. Un error en la ingesta no puede salir de aquí: paho lo
+        relanzaría y su hilo de red se detendría.
+        :return:
+        """
+        try:
+            self.handler(msg.topic, msg.payload)
+        except Exception:
+            logger.exception("Failed to ingest MQTT message")
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        """
+        Callback de confirmación de publicación. La espera se resuelve en el
+        event loop: ``publish`` registra su futuro sin ceder el control tras
+        llamar a paho, así que la confirmación nunca llega antes que el
+        registro, por rápida que sea.
+        :return:
+        """
+        loop = self.loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._acked, mid)
+
+    def _acked(self, mid):
+        fut = self._pending.pop(mid, None)
+        if fut is not None:
+            _resolve(fut)
+
+    async def start(self):
+        """
+        Arranca la conexión con el broker en segundo plano.
+        :return:
+        """
+        self.loop = asyncio.get_running_loop()
+        self._lost = asyncio.Event()
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        """
+        Conecta, arranca el hilo de red de paho y, cuando la conexión se
+        pierde, lo detiene, da por fallidas las publicaciones sin confirmar y
+        vuelve a conectar con un cliente nuevo tras una espera.
+        :return:
+        """
+        while True:
+            try:
+                await asyncio.to_thread(self.client.connect, self.host, self.port)
+            except OSError as e:
+                delay = self.backoff.next()
+                logger.warning(f"MQTT broker {self.host}:{self.port} unavailable ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            self._lost.clear()
+            self.client.loop_start()
+            await self._lost.wait()
+            self.connected = self.ready = False
+            await asyncio.to_thread(self.client.loop_stop)
+            self._fail_pending()
+            self.client = self._new_client()
+            delay = self.backoff.next()
+            logger.warning(f"MQTT connection lost, reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    def _fail_pending(self):
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception(ConnectionError("MQTT connection lost before the broker acknowledged"))
+
+    async def stop(self):
+        """
+        Detiene los reintentos, desconecta y detiene el hilo de red.
+        :return:
+        """
+        if self._task is not None:
+            self._task.cancel()
+        self._lost = None
+        self.client.disconnect()
+        await asyncio.to_thread(self.client.loop_stop)
+
+    async def publish(self, topic, payload, qos=1):
+        """
+        Publica ``payload`` y espera la confirmación del broker. Sin conexión
+        falla enseguida con ``ConnectionError`` en lugar de dejar el mensaje
+        en la cola de paho.
+        :param topic:
+        :param payload:
+        :param qos:
+        :return:
+        """
+        if not self.connected:
+            raise ConnectionError("Not connected to the MQTT broker")
+        info = self.client.publish(topic, payload, qos)
+        if info.rc != mqtt_client.MQTT_ERR_SUCCESS:
+            raise ConnectionError(mqtt_client.error_string(info.rc))
+        if qos == 0:
+            return
+        # Sin await entre la llamada a paho y el registro (ver _on_publish)
+        fut = self._pending[info.mid] = self.loop.create_future()
+        try:
+            await fut
+        finally:
+            if self._pending.get(info.mid) is fut:
+                del self._pending[info.mid]
+
+    def publish_nowait(self, topic, payload):
+        """
+        Publica ``payload`` con QoS 0 sin esperar. Se puede llamar desde
+        cualquier hilo.
+        :param topic:
+        :param payload:
+        :return:
+        """
+        self.client.publish(topic, payload, 0)
+
+
+class AsyncBroker:
+    """
+    Cliente aiomqtt que corre en el event loop de la aplicación.
+    """
+
+    def __init__(self, host, port, topics, handler, inflight=20, backoff=None):
+        """
+        :param host:
+        :param port:
+        :param topics: Topics a los que suscribirse
+        :param handler: ``handler(topic, payload)``, llamado en el event loop
+        :param inflight: Máximo de publicaciones QoS 1 sin confirmar
+        :param backoff: Backoff de los reintentos de conexión
+        """
+        self.host = host
+        self.port = port
+        self.topics = topics
+        self.handler = handler
+        self.inflight = inflight
+        self.backoff = backoff or Backoff()
+        self.client = None
+        self.connected = False
+        self.ready = False
+        self._task = None
+        self._background = set()
+
+    async def start(self):
+        """
+        Arranca en segundo plano la conexión con el broker y el bucle de ingesta.
+        :return:
+        """
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _supervise(self):
+        """
+        Conecta, se suscribe y consume mensajes; si la conexión se pierde,
+        vuelve a conectar tras una espera.
+        :return:
+        """
+        while True:
+            reason = "connection closed"
+            try:
+                async with aiomqtt.Client(self.host, self.port, max_inflight_messages=self.inflight) as client:
+                    self.client = client
+                    self.connected = True
+                    for topic in self.topics:
+                        if any(_refused(rc) for rc in await client.subscribe(topic)):
+                            raise aiomqtt.MqttError(f"Subscription refused for {topic}")
+                    self.ready = True
+                    self.backoff.reset()
+                    logger.info(f"MQTT connected to {self.host}:{self.port} and subscribed")
+                    await self._ingest(client)
+            except aiomqtt.MqttError as e:
+                reason = str(e)
+            finally:
+                self.client = None
+                self.connected = self.ready = False
+            delay = self.backoff.next()
+            logger.warning(f"MQTT broker {self.host}:{self.port} unavailable ({reason}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def _ingest(self, client):
+        async for message in client.messages:
+            try:
+                self.handler(message.topic.value, message.payload)
+            except Exception:
+                logger.exception("Failed to ingest MQTT message")
+
+    async def stop(self):
+        """
+        Detiene los reintentos y el bucle de ingesta, y desconecta.
+        :return:
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def publish(self, topic, payload, qos=1):
+        """
+        Publica ``payload`` y espera la confirmación del broker.
+        :param topic:
+        :param payload:
+        :param qos:
+        :return:
+        """
+        client = self.client
+        if client is None:
+            raise ConnectionError("Not connected to the MQTT broker")
+        try:
+            await client.publish(topic, payload, qos)
+        except aiomqtt.MqttError as e:
+            raise ConnectionError(str(e)) from e
+
+    def publish_nowait(self, topic, payload):
+        """
+        Publica ``payload`` con QoS 0 sin esperar. Debe llamarse desde el
+        event loop.
+        :param topic:
+        :param payload:
+        :return:
+        """
+        task = asyncio.create_task(self.publish(topic, payload, 0))
+        self._background.add(task)
+        task.add_done_callback(self._publish_done)
+
+    def _publish_done(self, task):
+        self._background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"MQTT publish failed: {task.exception()}")
+
+
+def _refused(granted):
+    """
+    Indica si una suscripción fue rechazada (código de SUBACK 0x80 o mayor).
+    :param granted: QoS concedido (MQTT 3.1.1) o ReasonCode (MQTT 5)
+    :return:
+    """
+    if isinstance(granted, int):
+        return granted >= 0x80
+    return granted.is_failure
+
+
+def _resolve(fut):
+    if not fut.done():
+        fut.set_result(None)
+
+
+def create_broker(mode, host, port, topics, handler, inflight=20, backoff=None):
+    """
+    Crea el cliente MQTT del modo indicado.
+    :param mode: ``thread`` o ``asyncio``
+    :param host:
+    :param port:
+    :param topics:
+    :param handler:
+    :param inflight:
+    :param backoff: Backoff de los reintentos de conexión
+    :return:
+    """
+    if mode == MODE_THREAD:
+        return ThreadedBroker(host, port, topics, handler, inflight, backoff)
+    if mode == MODE_ASYNCIO:
+        return AsyncBroker(host, port, topics, handler, inflight, backoff)
+    raise ValueError(f"Unknown MQTT client mode: {mode}")
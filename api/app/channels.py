@@ -0,0 +1,78 @@
+"""
+Canales de chat y su correspondencia con los topics MQTT.
+
+Cada canal tiene sus topics ``<prefijo>/<canal>/up`` y ``<prefijo>/<canal>/down``
+y la API se suscribe a todos con el comodín ``<prefijo>/+/up``. Los topics
+clásicos (``lorachat/up`` y ``lorachat/down``) siguen funcionando y
+corresponden al canal por defecto, así que un puente sin configurar no nota
+el cambio.
+"""
+import re
+
+# Nombres de canal válidos: deben caber en un nivel de topic MQTT
+CHANNEL_PATTERN = r"^[A-Za-z0-9_-]{1,32}$"
+_CHANNEL_RE = re.compile(CHANNEL_PATTERN)
+
+
+def parse_channels(value):
+    """
+    Convierte una lista de canales separados por comas en un conjunto.
+    :param value: Texto como ``"general,taller"`` o None
+    :return: frozenset con los canales, o None para todos los canales
+    """
+    if value is None or value == "":
+        return None
+    channels = frozenset(c.strip() for c in value.split(","))
+    for channel in channels:
+        if not _CHANNEL_RE.match(channel):
+            raise ValueError(f"Invalid channel name: {channel!r}")
+    return channels
+
+
+class TopicLayout:
+    """
+    Traduce entre canales y topics MQTT.
+    """
+
+    def __init__(self, prefix, default_channel, legacy_up, legacy_down):
+        """
+        :param prefix: Prefijo de los topics por canal (``lorachat``)
+        :param default_channel: Canal de los topics clásicos
+        :param legacy_up: Topic de subida clásico (``lorachat/up``)
+        :param legacy_down: Topic de bajada clásico (``lorachat/down``)
+        """
+        self.prefix = prefix
+        self.default_channel = default_channel
+        self.legacy_up = legacy_up
+        self.legacy_down = legacy_down
+
+    def subscriptions(self):
+        """
+        Topics de subida a los que hay que suscribirse.
+        :return:
+        """
+        return [f"{self.prefix}/+/up", self.legacy_up]
+
+    def channel_of(self, topic):
+        """
+        Devuelve el canal de un topic de subida, o None si no corresponde a
+        ningún canal válido.
+        :param topic:
+        :return:
+        """
+        if topic == self.legacy_up:
+            return self.default_channel
+        parts = topic.split("/")
+        if len(parts) != 3 or parts[0] != self.prefix or parts[2] != "up":
+            return None
+        return parts[1] if _CHANNEL_RE.match(parts[1]) else None
+
+    def down_topic(self, channel):
+        """
+        Topic en el que se publican los mensajes de bajada de un canal.
+        :param channel:
+        :return:
+        """
+        if channel == self.default_channel:
+            return self.legacy_down
+        return f"{self.prefix}/{channel}/down"
@@ -0,0 +1,74 @@
+"""
+Supresión de uplinks duplicados en la ingesta.
+
+Un mismo paquete LoRa puede llegar varias veces: reintentos QoS 1 de
+``umqtt.robust``, reenvíos de la cola de pendientes del puente o varios
+puentes que lo oyen a la vez. Cada uplink se identifica por su remitente, su
+número de mensaje (``id``, si el nodo lo envía) y un hash del texto, y se
+descarta si esa clave ya se vio dentro de la ventana.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class SeenSet:
+    """
+    Conjunto de claves vistas con caducidad (TTL) y tamaño máximo (LRU).
+
+    Las claves se guardan en orden de llegada con su instante de caducidad;
+    como el TTL es fijo, las más antiguas son también las primeras en caducar
+    y se purgan desde el principio. Consultar y añadir es O(1) amortizado y la
+    memoria nunca supera ``maxsize`` claves, aunque lleguen ráfagas.
+    """
+
+    def __init__(self, ttl=60.0, maxsize=10000):
+        """
+        :param ttl: Segundos durante los que una clave cuenta como vista
+        :param maxsize: Máximo de claves recordadas
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._seen = OrderedDict()     # clave -> instante (monotónico) de caducidad
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._seen)
+
+    def _expire(self, now):
+        seen = self._seen
+        while seen:
+            key, expiry = next(iter(seen.items()))
+            if expiry > now:
+                break
+            del seen[key]
+
+    def check(self, key):
+        """
+        Indica si ``key`` ya se vio dentro de la ventana; si no, la recuerda.
+        La ventana cuenta desde la primera vez que se vio la clave.
+        :param key:
+        :return: True si es un duplicado
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            if key in self._seen:
+                return True
+            self._seen[key] = now + self.ttl
+            if len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+            return False
+
+
+def uplink_key(sender, node_id, message):
+    """
+    Clave de deduplicación de un uplink. El texto entra como hash para no
+    confundir mensajes distintos con el mismo ``id`` (p. ej. tras reiniciar el
+    nodo) sin guardar el texto completo.
+    :param sender:
+    :param node_id: Número de mensaje del nodo, o None
+    :param message:
+    :return:
+    """
+    return sender, node_id, hash(message)
@@ -0,0 +1,273 @@
+"""
+Seguimiento del estado de entrega de los mensajes de bajada.
+
+Cada mensaje publicado en ``/publish/`` recibe un identificador que viaja en
+el paquete de ``lorachat/down`` y en la trama LoRa (``dl``). El mensaje pasa
+por estos estados:
+
+- ``queued``: aceptado por la API (en la cola del planificador, si lo hay)
+- ``brokered``: el broker confirmó la publicación (PUBACK)
+- ``transmitted``: el puente informó en el topic de estado del fin de la
+  transmisión LoRa (TX_DONE)
+- ``acked``: un nodo respondió ``ACK:dl:<id>``
+
+o, si la publicación o la transmisión fallan, ``failed``. Cada cambio se
+difunde a los clientes como un evento ``downlink``.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+import msgspec
+
+from .latency import PERCENTILES, percentile
+from .metrics import DOWNLINK_STATE_SECONDS
+
+QUEUED = "queued"
+BROKERED = "brokered"
+TRANSMITTED = "transmitted"
+ACKED = "acked"
+FAILED = "failed"
+
+# Orden de los estados; un mensaje nunca retrocede
+STATES = (QUEUED, BROKERED, TRANSMITTED, ACKED)
+_ORDER = {state: i for i, state in enumerate(STATES)}
+
+# Solo esta forma: el ``ACK:<n>`` antiguo de los nodos lleva su propio contador, no un id de bajada
+ACK_PATTERN = re.compile(r"^ACK:dl:(\d+)$")
+
+
+class DownlinkStatus(msgspec.Struct, tag="downlink", tag_field="type", omit_defaults=True):
+    """
+    Cambio de estado de un mensaje de bajada, tal como se envía a los clientes.
+    """
+    id: int
+    state: str
+    channel: str
+    ts: float
+    elapsed: float                 # segundos desde que se encoló
+    seq: int | None = None         # secuencia del mensaje en el histórico, una vez publicado
+    gateway: str | None = None     # puente que lo transmitió
+
+
+class StatusEvent:
+    """
+    Evento de estado listo para difundir por el hub, con sus codificaciones
+    calculadas una sola vez. No es un mensaje del histórico: ``msg`` es None.
+    """
+    __slots__ = ("status", "json", "text", "_sse", "_msgpack")
+    msg = None
+    trace = None
+
+    def __init__(self, status, json=None):
+        self.status = status
+        self.json = _encoder.encode(status) if json is None else json
+        self.text = self.json.decode()
+        self._sse = None
+        self._msgpack = None
+
+    @property
+    def sse(self):
+        """
+        Evento Server-Sent Events de tipo ``downlink``, sin ``id`` para no
+        mover el cursor de reconexión del cliente.
+        :return: bytes
+        """
+        if self._sse is None:
+            self._sse = b"event: downlink\ndata: %s\n\n" % self.json
+        return self._sse
+
+    @property
+    def msgpack(self):
+        if self._msgpack is None:
+            self._msgpack = _msgpack_encoder.encode(self.status)
+        return self._msgpack
+
+    @classmethod
+    def from_json(cls, raw):
+        """
+        Reconstruye un evento recibido de otro worker.
+        :param raw:
+        :return:
+        """
+        return cls(_status_decoder.decode(raw), bytes(raw))
+
+
+class BridgeReport(msgspec.Struct):
+    """
+    Informe del puente en el topic de estado: ``{"dl": 7, "state": "transmitted", "gw": "bridge-1"}``.
+    """
+    dl: int
+    state: str
+    gw: str | None = None
+
+
+_encoder = msgspec.json.Encoder()
+_msgpack_encoder = msgspec.msgpack.Encoder()
+_status_decoder = msgspec.json.Decoder(DownlinkStatus)
+_report_decoder = msgspec.json.Decoder(BridgeReport)
+
+
+def decode_report(raw):
+    """
+    Decodifica un informe del puente.
+    :param raw:
+    :return: BridgeReport, o None si no es válido
+    """
+    try:
+        report = _report_decoder.decode(raw)
+    except msgspec.DecodeError:
+        return None
+    return report if report.state in (TRANSMITTED, FAILED) else None
+
+
+class Downlink:
+    """
+    Estado de un mensaje de bajada.
+    """
+    __slots__ = ("id", "channel", "state", "created", "times", "seq", "gateway")
+
+    def __init__(self, id, channel, created):
+        self.id = id
+        self.channel = channel
+        self.state = QUEUED
+        self.created = created
+        self.times = {QUEUED: created}
+        self.seq = None
+        self.gateway = None
+
+    def to_dict(self):
+        return {"id": self.id, "channel": self.channel, "state": self.state, "seq": self.seq,
+                "gateway": self.gateway, "times": self.times}
+
+
+class DownlinkTracker:
+    """
+    Mensajes de bajada recientes y su estado. Guarda como máximo ``maxsize``
+    mensajes; al superarlo olvida los más antiguos.
+    """
+
+    def __init__(self, notify, maxsize=1000, window=1000):
+        """
+        :param notify: ``notify(event)``, llamado con cada StatusEvent (desde cualquier hilo)
+        :param maxsize: Máximo de mensajes seguidos
+        :param window: Muestras de latencia por estado para los percentiles
+        """
+        self.notify = notify
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._counts = {state: 0 for state in (*STATES, FAILED)}
+        self._latency = {state: deque(maxlen=window) for state in STATES[1:]}
+        self._observers = {state: DOWNLINK_STATE_SECONDS.labels(state) for state in STATES[1:]}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def create(self, id, channel):
+        """
+        Empieza a seguir un mensaje en estado ``queued``.
+        :param id:
+        :param channel:
+        :return:
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items[id] = Downlink(id, channel, now)
+            self._counts[QUEUED] += 1
+            if len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+            event = self._event(item, now)
+        self.notify(event)
+
+    def advance(self, id, state, seq=None, gateway=None):
+        """
+        Pasa un mensaje a ``state``. Se ignora si el mensaje no es de este
+        proceso, si ya falló o si ya está en ese estado o en uno posterior.
+        Un mensaje solo puede fallar antes de transmitirse.
+        :param id:
+        :param state:
+        :param seq: Secuencia del mensaje en el histórico
+        :param gateway: Puente que lo transmitió
+        :return: True si el estado cambió
+        """
+        now = time.time()
+        with self._lock:
+            item = self._items.get(id)
+            if item is None or item.state == FAILED:
+                return False
+            if state == FAILED:
+                if _ORDER[item.state] >= _ORDER[TRANSMITTED]:
+                    return False
+            elif _ORDER[state] <= _ORDER[item.state]:
+                # Informe atrasado (p. ej. la transmisión después del ACK): se anota sin difundirlo
+                item.times.setdefault(state, now)
+                if item.gateway is None:
+                    item.gateway = gateway
+                return False
+            item.state = state
+            item.times[state] = now
+            if seq is not None:
+                item.seq = seq
+            if gateway is not None:
+                item.gateway = gateway
+            self._counts[state] += 1
+            if state != FAILED:
+                elapsed = now - item.created
+                self._latency[state].append(elapsed)
+                self._observers[state].observe(elapsed)
+            event = self._event(item, now)
+        self.notify(event)
+        return True
+
+    def ack(self, text):
+        """
+        Si ``text`` es una confirmación ``ACK:dl:<id>`` de un nodo, marca el
+        mensaje como ``acked``.
+        :param text: Texto de un mensaje de subida
+        :return: True si correspondía a un mensaje seguido
+        """
+        match = ACK_PATTERN.match(text)
+        if match is None:
+            return False
+        return self.advance(int(match.group(1)), ACKED)
+
+    def get(self, id):
+        """
+        Estado de un mensaje, o None si no se sigue.
+        :param id:
+        :return:
+        """
+        with self._lock:
+            item = self._items.get(id)
+            return item.to_dict() if item is not None else None
+
+    def summary(self):
+        """
+        Mensajes que han alcanzado cada estado, proporción de entregas
+        confirmadas y percentiles del tiempo desde ``queued`` hasta cada
+        estado, en milisegundos.
+        :return:
+        """
+        with self._lock:
+            counts = dict(self._counts)
+            snapshot = {state: sorted(samples) for state, samples in self._latency.items()}
+        brokered = counts[BROKERED]
+        latency = {}
+        for state, values in snapshot.items():
+            entry = {"count": len(values)}
+            for p in PERCENTILES:
+                entry[f"p{p}"] = round(percentile(values, p) * 1000, 1) if values else None
+            latency[state] = entry
+        return {
+            "tracked": len(self._items),
+            "states": counts,
+            "delivery_ratio": round(counts[ACKED] / brokered, 4) if brokered else None,
+            "latency_ms": latency,
+        }
+
+    @staticmethod
+    def _event(item, now):
+        return StatusEvent(DownlinkStatus(item.id, item.state, item.channel, now, round(now - item.created, 6),
+                                          item.seq, item.gateway))
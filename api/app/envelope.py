@@ -0,0 +1,135 @@
+"""
+Sobre binario compacto para los paquetes MQTT de subida y bajada.
+
+Alternativa al JSON ``{"from": ..., "message": ...}``: ocupa menos en el
+broker y se decodifica sin parser. El primer byte es ``MAGIC`` (0xB1), que
+nunca puede empezar un texto UTF-8 ni un JSON, así que ambos formatos
+conviven en los mismos topics. Todos los enteros son big-endian::
+
+    magic    u8   0xB1
+    version  u8   1
+    flags    u8   campos opcionales presentes (FLAG_*)
+    sender   u8 longitud + UTF-8
+    seq      u32                       si FLAG_SEQ
+    ts       u64  ms desde 1970        si FLAG_TS (recepción LoRa o envío)
+    pub      u64  ms desde 1970        si FLAG_PUB (publicación MQTT del puente)
+    gateway  u8 longitud + UTF-8, rssi i16, snr i16 (décimas)   si FLAG_GW
+    body     u16 longitud + UTF-8
+
+El puente (``uPython/Heltec_V3_uP_Bridge_Node``) implementa el mismo formato.
+"""
+import struct
+
+MAGIC = 0xB1
+VERSION = 1
+
+FLAG_SEQ = 0x01
+FLAG_TS = 0x02
+FLAG_PUB = 0x04
+FLAG_GW = 0x08
+
+_HEAD = struct.Struct(">BBBB")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+_SIGNAL = struct.Struct(">hh")
+_NO_SIGNAL = -0x8000    # rssi/snr desconocido
+
+
+class EnvelopeError(ValueError):
+    """
+    Sobre binario mal formado o de una versión desconocida.
+    """
+
+
+def is_envelope(raw):
+    """
+    Indica si un paquete MQTT es un sobre binario.
+    :param raw:
+    :return:
+    """
+    return len(raw) > 0 and raw[0] == MAGIC
+
+
+def pack(sender, body, seq=None, ts=None, pub=None, gateway=None):
+    """
+    Codifica un sobre binario.
+    :param sender: Remitente
+    :param body: Texto del mensaje
+    :param seq: Número de mensaje, o None
+    :param ts: Instante en ms desde 1970, o None
+    :param pub: Instante de publicación en ms desde 1970, o None
+    :param gateway: (id, rssi, snr) del puente, o None
+    :return: bytes
+    """
+    sender_b = sender.encode()
+    body_b = body.encode()
+    if len(sender_b) > 0xFF or len(body_b) > 0xFFFF:
+        raise ValueError("Sender or body too long for an envelope")
+    flags = 0
+    parts = [b"", sender_b]
+    if seq is not None:
+        flags |= FLAG_SEQ
+        parts.append(_U32.pack(seq & 0xFFFFFFFF))
+    if ts is not None:
+        flags |= FLAG_TS
+        parts.append(_U64.pack(ts))
+    if pub is not None:
+        flags |= FLAG_PUB
+        parts.append(_U64.pack(pub))
+    if gateway is not None:
+        flags |= FLAG_GW
+        gw_id, rssi, snr = gateway
+        gw_b = gw_id.encode()
+        if len(gw_b) > 0xFF:
+            raise ValueError("Gateway id too long for an envelope")
+        parts += [bytes((len(gw_b),)), gw_b, _SIGNAL.pack(_tenths(rssi), _tenths(snr))]
+    parts += [_U16.pack(len(body_b)), body_b]
+    parts[0] = _HEAD.pack(MAGIC, VERSION, flags, len(sender_b))
+    return b"".join(parts)
+
+
+def unpack(raw):
+    """
+    Decodifica un sobre binario. Lanza ``EnvelopeError`` si está mal formado.
+    :param raw:
+    :return: (sender, body, seq, ts, pub, gateway), con None en los campos ausentes
+        y ``gateway`` como (id, rssi, snr)
+    """
+    try:
+        magic, version, flags, n = _HEAD.unpack_from(raw, 0)
+        if magic != MAGIC or version != VERSION:
+            raise EnvelopeError(f"Unsupported envelope version {version}")
+        pos = _HEAD.size + n
+        sender = str(raw[_HEAD.size:pos], "utf-8")
+        seq = ts = pub = gateway = None
+        if flags & FLAG_SEQ:
+            seq, = _U32.unpack_from(raw, pos)
+            pos += 4
+        if flags & FLAG_TS:
+            ts, = _U64.unpack_from(raw, pos)
+            pos += 8
+        if flags & FLAG_PUB:
+            pub, = _U64.unpack_from(raw, pos)
+            pos += 8
+        if flags & FLAG_GW:
+            end = pos + 1 + raw[pos]
+            rssi, snr = _SIGNAL.unpack_from(raw, end)
+            gateway = (str(raw[pos + 1:end], "utf-8"), _from_tenths(rssi), _from_tenths(snr))
+            pos = end + _SIGNAL.size
+        n, = _U16.unpack_from(raw, pos)
+        pos += 2
+        if pos + n != len(raw):
+            raise EnvelopeError("Envelope length mismatch")
+        body = str(raw[pos:], "utf-8")
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise EnvelopeError(f"Malformed envelope: {e}") from None
+    return sender, body, seq, ts, pub, gateway
+
+
+def _tenths(value):
+    return _NO_SIGNAL if value is None else max(-0x7FFF, min(0x7FFF, round(value * 10)))
+
+
+def _from_tenths(value):
+    return None if value == _NO_SIGNAL else value / 10
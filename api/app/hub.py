@@ -0,0 +1,170 @@
+"""
+Hub de difusión para los clientes en tiempo real.
+
+Cada cliente tiene su propia cola acotada. Un mensaje nuevo se escribe una sola
+vez en la cola de cada suscriptor y el cliente lo envía cuando su socket está
+libre, así que con el sistema en reposo no se ejecuta nada.
+
+Los clientes pueden suscribirse solo a algunos canales. Los suscriptores se
+agrupan por canal, así que un mensaje solo recorre los clientes interesados en
+su canal y los que reciben todos.
+"""
+import asyncio
+import itertools
+import logging
+import time
+
+from .metrics import CLIENT_DROPPED, CLIENT_KICKED, FANOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Políticas para clientes lentos (cola llena)
+POLICY_DROP = "drop"              # descarta el mensaje más antiguo de la cola
+POLICY_DISCONNECT = "disconnect"  # expulsa al cliente
+
+
+class Subscriber:
+    """
+    Cola acotada de un cliente conectado.
+    """
+    __slots__ = ("id", "queue", "channels", "dropped", "closed")
+
+    _ids = itertools.count(1)
+
+    def __init__(self, maxsize, channels=None):
+        self.id = next(self._ids)
+        self.queue = asyncio.Queue(maxsize)
+        self.channels = channels
+        self.dropped = 0
+        self.closed = False
+
+    def close(self):
+        """
+        Marca el suscriptor como cerrado y despierta a su consumidor con un
+        centinela ``None``.
+        :return:
+        """
+        self.closed = True
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+class BroadcastHub:
+    """
+    Difunde cada mensaje a todos los suscriptores desde el event loop.
+    """
+
+    def __init__(self, queue_size=100, policy=POLICY_DROP):
+        """
+        :param queue_size: Tamaño máximo de la cola de cada cliente
+        :param policy: ``drop`` o ``disconnect`` para clientes lentos
+        """
+        if policy not in (POLICY_DROP, POLICY_DISCONNECT):
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.subscribers = set()       # suscritos a todos los canales
+        self.by_channel = {}           # canal -> suscriptores de ese canal
+        self.loop = None
+
+    def bind(self, loop):
+        """
+        Asocia el hub al event loop de la aplicación. Debe llamarse desde el
+        hilo del propio loop.
+        :param loop:
+        :return:
+        """
+        self.loop = loop
+
+    def subscribe(self, channels=None):
+        """
+        Registra un nuevo cliente y devuelve su suscriptor.
+        :param channels: Canales que le interesan, o None para todos
+        :return:
+        """
+        sub = Subscriber(self.queue_size, channels)
+        if channels is None:
+            self.subscribers.add(sub)
+        else:
+            for channel in channels:
+                self.by_channel.setdefault(channel, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        """
+        Elimina un cliente del hub.
+        :param sub:
+        :return:
+        """
+        if sub.channels is None:
+            self.subscribers.discard(sub)
+            return
+        for channel in sub.channels:
+            subs = self.by_channel.get(channel)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self.by_channel[channel]
+
+    def all_subscribers(self):
+        """
+        Conjunto de todos los suscriptores conectados.
+        :return:
+        """
+        subs = set(self.subscribers)
+        for channel_subs in self.by_channel.values():
+            subs |= channel_subs
+        return subs
+
+    def publish(self, item, channel=None):
+        """
+        Encola ``item`` una vez para cada suscriptor de su canal y para los
+        suscritos a todos. Debe llamarse desde el event loop.
+        :param item:
+        :param channel: Canal del mensaje
+        :return:
+        """
+        start = time.perf_counter()
+        targets = tuple(self.subscribers)
+        if channel in self.by_channel:
+            targets += tuple(self.by_channel[channel])
+        for sub in targets:
+            try:
+                sub.queue.put_nowait(item)
+            except asyncio.QueueFull:
+                if self.policy == POLICY_DROP:
+                    sub.queue.get_nowait()
+                    sub.queue.put_nowait(item)
+                    sub.dropped += 1
+                    CLIENT_DROPPED.inc()
+                else:
+                    logger.warning("Disconnecting slow WebSocket client")
+                    self.unsubscribe(sub)
+                    sub.close()
+                    CLIENT_KICKED.inc()
+        FANOUT_SECONDS.observe(time.perf_counter() - start)
+
+    def publish_threadsafe(self, item, channel=None):
+        """
+        Entrega ``item`` al event loop desde cualquier hilo (p. ej. el de
+        paho), en orden con el resto de llamadas de ``call_threadsafe``.
+        :param item:
+        :param channel: Canal del mensaje
+        :return:
+        """
+        self.call_threadsafe(self.publish, item, channel)
+
+    def call_threadsafe(self, fn, *args):
+        """
+        Ejecuta ``fn(*args)`` en el event loop del hub desde cualquier hilo.
+        Siempre pasa por la cola del loop, también desde su propio hilo: las
+        llamadas se ejecutan en el orden en que se hicieron.
+        :param fn:
+        :param args:
+        :return:
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        loop.call_soon_threadsafe(fn, *args)
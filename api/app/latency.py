@@ -0,0 +1,133 @@
+"""
+Latencia de extremo a extremo de los mensajes de subida, por tramos.
+
+Cada mensaje de subida lleva las marcas de tiempo que añade el puente
+(recepción LoRa y publicación MQTT, en ms desde 1970) y la API añade las
+suyas: ingesta, encolado para la difusión y envío por el socket. Los tramos
+son:
+
+- ``bridge``: de la recepción LoRa a la publicación MQTT en el puente
+- ``mqtt``: de la publicación del puente a la ingesta en la API (QoS 1,
+  Mosquitto, red)
+- ``api``: de la ingesta al encolado para la difusión
+- ``fanout``: del encolado al envío por el WebSocket o SSE de cada cliente
+- ``total``: de la recepción LoRa al envío al cliente
+
+Los tramos que cruzan del puente a la API dependen de que ambos relojes
+estén sincronizados (SNTP), así que su error es el desfase entre ellos.
+"""
+import threading
+from collections import deque
+
+from .metrics import HOP_SECONDS
+
+HOPS = ("bridge", "mqtt", "api", "fanout", "total")
+PERCENTILES = (50, 95, 99)
+
+
+class Trace:
+    """
+    Marcas de tiempo de un mensaje, en segundos desde 1970.
+    """
+    __slots__ = ("rx", "pub", "ingest", "fanout")
+
+    def __init__(self, rx, pub, ingest):
+        self.rx = rx
+        self.pub = pub
+        self.ingest = ingest
+        self.fanout = None
+
+    @classmethod
+    def from_stamps(cls, stamps, ingest):
+        """
+        Crea la traza de un mensaje a partir de las marcas del puente.
+        :param stamps: messages.Stamps (ms desde 1970) o None
+        :param ingest: Instante de la ingesta en la API
+        :return:
+        """
+        if stamps is None:
+            return cls(None, None, ingest)
+        return cls(_seconds(stamps.rx), _seconds(stamps.pub), ingest)
+
+
+class LatencyTracker:
+    """
+    Percentiles móviles de cada tramo sobre las últimas ``window`` muestras.
+    """
+
+    def __init__(self, window=1000):
+        """
+        :param window: Muestras que se conservan por tramo
+        """
+        self.window = window
+        self._samples = {hop: deque(maxlen=window) for hop in HOPS}
+        self._observers = {hop: HOP_SECONDS.labels(hop) for hop in HOPS}
+        self._lock = threading.Lock()
+
+    def _add(self, hop, seconds):
+        self._observers[hop].observe(seconds)
+        with self._lock:
+            self._samples[hop].append(seconds)
+
+    def ingested(self, trace):
+        """
+        Registra los tramos del puente y de MQTT de un mensaje recién recibido.
+        :param trace:
+        :return:
+        """
+        if trace.rx is not None and trace.pub is not None:
+            self._add("bridge", trace.pub - trace.rx)
+        if trace.pub is not None:
+            self._add("mqtt", trace.ingest - trace.pub)
+
+    def enqueued(self, trace, now):
+        """
+        Registra el tramo de la API al encolar el mensaje para la difusión.
+        :param trace:
+        :param now:
+        :return:
+        """
+        trace.fanout = now
+        self._add("api", now - trace.ingest)
+
+    def delivered(self, trace, now):
+        """
+        Registra los tramos finales al enviar el mensaje a un cliente.
+        :param trace:
+        :param now:
+        :return:
+        """
+        if trace.fanout is not None:
+            self._add("fanout", now - trace.fanout)
+        if trace.rx is not None:
+            self._add("total", now - trace.rx)
+
+    def summary(self):
+        """
+        Número de muestras y percentiles de cada tramo, en milisegundos.
+        :return:
+        """
+        with self._lock:
+            snapshot = {hop: sorted(samples) for hop, samples in self._samples.items()}
+        result = {}
+        for hop, values in snapshot.items():
+            entry = {"count": len(values)}
+            for p in PERCENTILES:
+                entry[f"p{p}"] = round(percentile(values, p) * 1000, 2) if values else None
+            result[hop] = entry
+        return result
+
+
+def _seconds(ms):
+    return ms / 1000 if ms is not None else None
+
+
+def percentile(values, p):
+    """
+    Percentil ``p`` (método del rango más cercano) de una lista ordenada.
+    :param values:
+    :param p:
+    :return:
+    """
+    rank = max(1, -(-len(values) * p // 100))
+    return values[rank - 1]
@@ -1,13 +1,36 @@
 import os
-import json
-from fastapi import FastAPI, Request
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import WebSocket
-from collections import deque
-from paho.mqtt import client as mqtt_client
-from pydantic import BaseModel
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, Field
 import logging
 import asyncio
+import math
+import threading
+import time
+import zlib
+from typing import Literal
+
+from collections import OrderedDict
+from operator import attrgetter
+
+from .airtime import downlink_frame_length, time_on_air
+from .broker import Backoff, create_broker
+from .channels import CHANNEL_PATTERN, TopicLayout, parse_channels
+from .dedupe import SeenSet, uplink_key
+from .downlinks import BROKERED, FAILED, DownlinkTracker, StatusEvent, decode_report
+from .merge import MergeWindow
+from . import metrics
+from .hub import BroadcastHub
+from .latency import LatencyTracker, Trace
+from .messages import Message, Record, decode_uplink, encode, encode_downlink, encode_list, encode_list_msgpack
+from .ratelimit import AirtimeLimiter, Limit, parse_limits
+from .ring import RingBuffer
+from .scheduler import DownlinkScheduler
+from .store import MessageStore, match_expression
+from .waiters import MessageWaiters
 
 
 # Configuración MQTT
@@ -15,13 +38,118 @@ MQTT_BROKER = os.getenv("MQTT_BROKER", "mosquitto")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_TOPIC_UP   = os.getenv("MQTT_TOPIC_UP",   "lorachat/up")
 MQTT_TOPIC_DOWN = os.getenv("MQTT_TOPIC_DOWN", "lorachat/down")
+# Canales: <prefijo>/<canal>/up|down; los topics clásicos son el canal por defecto
+MQTT_TOPIC_PREFIX = os.getenv("MQTT_TOPIC_PREFIX", "lorachat")
+DEFAULT_CHANNEL   = os.getenv("DEFAULT_CHANNEL", "general")
+MQTT_TOPIC_EVENTS = os.getenv("MQTT_TOPIC_EVENTS", "lorachat/api/events")
+# Informes del puente sobre la transmisión de los mensajes de bajada (downlinks.py)
+MQTT_TOPIC_STATUS = os.getenv("MQTT_TOPIC_STATUS", "lorachat/status")
+# Canales cuyos mensajes de bajada se publican en sobre binario (envelope.py);
+# los de subida se aceptan en ambos formatos en cualquier canal
+BINARY_CHANNELS = parse_channels(os.getenv("BINARY_CHANNELS")) or frozenset()
+MQTT_CLIENT_MODE = os.getenv("MQTT_CLIENT_MODE", "thread")   # thread | asyncio
+MQTT_QOS = int(os.getenv("MQTT_QOS", 1))
+MQTT_PUBLISH_TIMEOUT = float(os.getenv("MQTT_PUBLISH_TIMEOUT", 5))
+MQTT_INFLIGHT = int(os.getenv("MQTT_INFLIGHT", 20))
+# Reintentos de conexión con el broker: espera exponencial con jitter, en segundos
+MQTT_RECONNECT_MIN = float(os.getenv("MQTT_RECONNECT_MIN", 0.5))
+MQTT_RECONNECT_MAX = float(os.getenv("MQTT_RECONNECT_MAX", 30))
+PUBLISH_BATCH_MAX = int(os.getenv("PUBLISH_BATCH_MAX", 500))
+
+# Parámetros de radio del puente (deben coincidir con su .env) y ciclo de trabajo
+LORA_SPREADING_FACTOR = int(os.getenv("LORA_SPREADING_FACTOR", 7))
+LORA_BANDWIDTH        = float(os.getenv("LORA_BANDWIDTH", 125.0))
+LORA_CODING_RATE      = int(os.getenv("LORA_CODING_RATE", 5))
+LORA_PREAMBLE         = int(os.getenv("LORA_PREAMBLE", 8))
+LORA_DUTY_CYCLE       = float(os.getenv("LORA_DUTY_CYCLE", 0.01))   # 0 = sin límite
+DOWNLINK_QUEUE_MAX    = int(os.getenv("DOWNLINK_QUEUE_MAX", 1000))
+DOWNLINK_TRACK_MAX    = int(os.getenv("DOWNLINK_TRACK_MAX", 1000))   # mensajes de bajada seguidos en /downlinks
+
+# Límite de /publish/ por cliente (IP o API key de RATE_LIMIT_CLIENTS), en
+# tiempo en el aire: fracción del canal que puede ocupar y ráfaga en segundos
+RATE_LIMIT_AIRTIME = float(os.getenv("RATE_LIMIT_AIRTIME", 0.0025))   # 0 = sin límite
+RATE_LIMIT_BURST   = float(os.getenv("RATE_LIMIT_BURST", 2))
+RATE_LIMIT_CLIENTS = os.getenv("RATE_LIMIT_CLIENTS", "")               # cliente=rate:burst,...
+
+# Varios workers de uvicorn: ingesta repartida con suscripciones compartidas
+# de MQTT ($share/), histórico común en SQLite y difusión por MQTT_TOPIC_EVENTS
+API_WORKERS       = int(os.getenv("API_WORKERS", 1))
+MQTT_SHARED_GROUP = os.getenv("MQTT_SHARED_GROUP", "lorachat-api")
+CLUSTER = API_WORKERS > 1
+# Eventos de estado de los mensajes de bajada entre workers
+EVENTS_DOWNLINK = f"{MQTT_TOPIC_EVENTS}/downlink"
+
+# Supresión de duplicados en la ingesta (DEDUPE_TTL=0 la desactiva)
+DEDUPE_TTL = float(os.getenv("DEDUPE_TTL", 60))      # s durante los que se recuerda un uplink
+DEDUPE_MAX = int(os.getenv("DEDUPE_MAX", 10000))     # máximo de uplinks recordados
+# Ventana para combinar las copias de un uplink oídas por varios puentes (0 = sin combinar)
+MERGE_WINDOW = float(os.getenv("MERGE_WINDOW", 0.3))
+
+# Configuración WebSocket
+WS_QUEUE_SIZE  = int(os.getenv("WS_QUEUE_SIZE", 100))
+WS_SLOW_POLICY = os.getenv("WS_SLOW_POLICY", "drop")   # drop | disconnect
+WS_REPLAY_MAX  = int(os.getenv("WS_REPLAY_MAX", 1000))
+WS_BATCH_MAX   = int(os.getenv("WS_BATCH_MAX", 50))    # mensajes por frame en vivo (subprotocolo msgpack)
+
+# Subprotocolos WebSocket: JSON en frames de texto (por defecto) o MessagePack en frames binarios
+SUBPROTOCOL_JSON = "lorachat.json"
+SUBPROTOCOL_MSGPACK = "lorachat.msgpack"
 
+# Configuración Server-Sent Events
+SSE_HEARTBEAT = float(os.getenv("SSE_HEARTBEAT", 15))   # s entre comentarios de keep-alive
 
-# Buffer circular de mensajes
-RECEIVED = deque(maxlen=100)
-clients = []
+# Latencia por tramos: muestras con las que se calculan los percentiles de /latency
+LATENCY_WINDOW = int(os.getenv("LATENCY_WINDOW", 1000))
+
+# Configuración del histórico
+HISTORY_DB       = os.getenv("HISTORY_DB", "/data/lorachat.db")
+HISTORY_BATCH_MS = int(os.getenv("HISTORY_BATCH_MS", 10))
+HISTORY_CACHE    = int(os.getenv("HISTORY_CACHE", 100))
+CHANNEL_CACHE_MAX = int(os.getenv("CHANNEL_CACHE_MAX", 64))   # canales con caché propia; el resto filtra la global
+SEARCH_LIMIT_MAX = int(os.getenv("SEARCH_LIMIT_MAX", 100))   # máx. resultados por página de /messages/search
+LONGPOLL_TIMEOUT_MAX = float(os.getenv("LONGPOLL_TIMEOUT_MAX", 60))   # s máx. de espera en /messages/wait
+
+
+# Buffer circular de mensajes (caché de los más recientes), uno más por cada
+# canal con actividad reciente (como mucho CHANNEL_CACHE_MAX), e histórico SQLite
+RECEIVED = RingBuffer(HISTORY_CACHE, key=attrgetter("msg.seq"))
+CHANNEL_CACHE = OrderedDict()  # canal -> RingBuffer, del menos al más reciente
+store = MessageStore(HISTORY_DB, batch_window=HISTORY_BATCH_MS / 1000, default_channel=DEFAULT_CHANNEL)
+layout = TopicLayout(MQTT_TOPIC_PREFIX, DEFAULT_CHANNEL, MQTT_TOPIC_UP, MQTT_TOPIC_DOWN)
+_seq = 0
+_seq_lock = threading.Lock()
+hub = BroadcastHub(WS_QUEUE_SIZE, WS_SLOW_POLICY)
+latency = LatencyTracker(LATENCY_WINDOW)
+seen = SeenSet(DEDUPE_TTL, DEDUPE_MAX) if DEDUPE_TTL > 0 else None
+waiters = MessageWaiters()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Ciclo de vida de la aplicación. Asocia el hub al event loop para que el
+    hilo de paho pueda entregarle mensajes, arranca la conexión MQTT (en
+    segundo plano: la API responde aunque el broker aún no esté disponible,
+    y ``/readyz`` indica cuándo lo está) y el planificador de bajada.
+    :param app:
+    :return:
+    """
+    hub.bind(asyncio.get_running_loop())
+    if merger is not None:
+        merger.bind(asyncio.get_running_loop())
+    await broker.start()
+    if scheduler is not None:
+        scheduler.start()
+    yield
+    if merger is not None:
+        merger.bind(None)
+    if scheduler is not None:
+        await scheduler.stop()
+    await broker.stop()
+    hub.bind(None)
+    store.close()
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -34,61 +162,356 @@ app.add_middleware(
 
 class PublishPayload(BaseModel):
     message: str
+    channel: str = Field(DEFAULT_CHANNEL, pattern=CHANNEL_PATTERN)
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 logger.info(f"MQTT Broker: {MQTT_BROKER}")
 logger.info(f"MQTT Port: {MQTT_PORT}")
-logger.info(f"MQTT Topic: {MQTT_TOPIC_UP}")
+logger.info(f"MQTT Topics: {', '.join(layout.subscriptions())}")
+logger.info(f"MQTT client mode: {MQTT_CLIENT_MODE}")
+if CLUSTER:
+    logger.info(f"Cluster mode: {API_WORKERS} workers, shared group {MQTT_SHARED_GROUP}")
 
 
-# Callbacks MQTT
-def on_connect(client, userdata, flags, rc):
+def store_message(topic, payload, source, channel, trace=None, gateways=None):
     """
-    Callback de conexión MQTT. Se llama cuando el cliente se conecta al broker.
-    :param client:
-    :param userdata:
-    :param flags:
-    :param rc:
+    Asigna al mensaje el siguiente número de secuencia y una marca de tiempo
+    del servidor, lo guarda en el histórico y lo difunde a los clientes. Se
+    llama tanto desde el hilo de paho como desde el event loop.
+
+    Con varios workers la numeración sale del contador compartido de SQLite
+    y la difusión pasa por ``MQTT_TOPIC_EVENTS`` para llegar a los clientes
+    de todos los workers, incluido este.
+    :param topic:
+    :param payload:
+    :param source:
+    :param channel:
+    :param trace: Marcas de tiempo del mensaje (solo subida)
+    :param gateways: Puentes que recibieron el mensaje (solo subida)
+    :return: El mensaje guardado
+    """
+    global _seq
+    if CLUSTER:
+        record = Record(Message(store.allocate_seq(), time.time(), topic, payload, source, channel, gateways))
+        store.append(record)
+        broker.publish_nowait(MQTT_TOPIC_EVENTS, record.json)
+        return record
+    with _seq_lock:
+        _seq += 1
+        record = Record(Message(_seq, time.time(), topic, payload, source, channel, gateways), trace=trace)
+        RECEIVED.append(record)
+        ring = CHANNEL_CACHE.get(channel)
+        if ring is not None:
+            ring.append(record)
+            CHANNEL_CACHE.move_to_end(channel)
+        else:
+            # Cualquiera puede publicar en canales nuevos: se olvida la caché
+            # del canal menos activo, que pasa a filtrar la global. La nueva
+            # parte de la global para incluir lo que aún no esté escrito.
+            ring = RingBuffer(HISTORY_CACHE, key=attrgetter("msg.seq"))
+            ring.extend(_only(RECEIVED.snapshot(), (channel,)))
+            CHANNEL_CACHE[channel] = ring
+            if len(CHANNEL_CACHE) > CHANNEL_CACHE_MAX:
+                CHANNEL_CACHE.popitem(last=False)
+        store.append(record)
+        # Dentro del cerrojo: la difusión sale en el mismo orden que la numeración
+        hub.call_threadsafe(fan_out, record)
+    return record
+
+
+def fan_out(record):
+    """
+    Difunde un mensaje desde el event loop, anotando cuándo se encola, y
+    despierta a las peticiones de ``/messages/wait``.
+    :param record:
     :return:
     """
-    client.subscribe(MQTT_TOPIC_UP)
+    if record.trace is not None:
+        latency.enqueued(record.trace, time.time())
+    hub.publish(record, record.msg.channel)
+    waiters.notify(record.msg.seq, record.msg.channel)
+    if record.msg.source != "sent":
+        # Con varios workers cada uno sigue sus propios mensajes de bajada
+        tracker.ack(record.msg.payload)
 
 
-def on_message(client, userdata, msg):
+def deliver_event(payload):
     """
-    Callback de mensaje MQTT. Se llama cuando se recibe un mensaje en un topic suscrito.
-    :param client:
-    :param userdata:
-    :param msg:
+    Entrega a los clientes de este worker un mensaje guardado por cualquier
+    worker (modo de varios workers).
+    :param payload: JSON del mensaje publicado en ``MQTT_TOPIC_EVENTS``
     :return:
     """
-    payload_str = msg.payload.decode()
-    try:
-        data = json.loads(payload_str)
-        message = data.get("message", payload_str)
-        sender = data.get("from", "desconocido")
-    except Exception:
-        message = payload_str
-        sender = "desconocido"
-
-    RECEIVED.append({
-        "topic": msg.topic,
-        "payload": message,
-        "source": sender
-    })
-    logger.info(f"Received message: {data} from topic: {msg.topic}")
-
-# Crear cliente MQTT
-mqtt = mqtt_client.Client()
-mqtt.on_connect = on_connect
-mqtt.on_message = on_message
-try:
-    mqtt.connect(MQTT_BROKER, MQTT_PORT)
-    mqtt.loop_start()
-except Exception as e:
-    logger.error(f"Failed to connect to MQTT broker: {e}")
-    raise
+    global _seq
+    record = Record.from_json(payload)
+    _seq = max(_seq, record.msg.seq)
+    hub.call_threadsafe(fan_out, record)
+
+
+def _cache_for(channels):
+    """
+    Caché con todos los mensajes recientes de ``channels`` y los canales por
+    los que hay que filtrarla. Un canal con caché propia la usa; varios
+    canales, o uno sin caché propia (sin mensajes recientes), filtran la
+    caché global.
+    Así lo que aún espera en la cola de escritura de SQLite sale siempre de
+    memoria. Con varios workers no hay caché: (None, None).
+    :param channels:
+    :return: (caché, canales a filtrar o None)
+    """
+    if CLUSTER:
+        return None, None
+    if channels is None:
+        return RECEIVED, None
+    if len(channels) == 1:
+        cache = CHANNEL_CACHE.get(next(iter(channels)))
+        if cache is not None:
+            return cache, None
+    return RECEIVED, channels
+
+
+def _only(records, channels):
+    """
+    Mensajes de ``records`` que son de ``channels`` (todos si es None).
+    :param records:
+    :param channels:
+    :return:
+    """
+    if channels is None:
+        return records
+    return [r for r in records if r.msg.channel in channels]
+
+
+def history_page(limit, before, channels=None):
+    """
+    Devuelve hasta ``limit`` mensajes con secuencia menor que ``before``, en
+    orden cronológico. Los más recientes salen de la caché y el resto de
+    SQLite, a partir del más antiguo de la caché. Con varios workers se lee
+    siempre el histórico compartido.
+    :param limit:
+    :param before:
+    :param channels: Canales a incluir, o None para todos
+    :return:
+    """
+    if limit <= 0:
+        return []
+    cache, wanted = _cache_for(channels)
+    if cache is None:
+        return store.page(limit, before, channels)
+    window = cache.before(before, limit if wanted is None else cache.capacity)
+    part = _only(window, wanted)[-limit:]
+    missing = limit - len(part)
+    if missing > 0:
+        oldest = cache.oldest()
+        floor = window[0].msg.seq if window else min(before, oldest.msg.seq) if oldest else before
+        part = store.page(missing, floor, channels) + part
+    return part
+
+
+def history_since(seq, limit=WS_REPLAY_MAX, channels=None):
+    """
+    Devuelve los mensajes con secuencia mayor que ``seq`` (como máximo los
+    ``limit`` más recientes), en orden cronológico.
+    :param seq:
+    :param limit:
+    :param channels: Canales a incluir, o None para todos
+    :return:
+    """
+    cache, wanted = _cache_for(channels)
+    if cache is None:
+        return store.between(seq, _seq + 1, limit, channels)
+    window = cache.after(seq, limit if wanted is None else cache.capacity)
+    part = _only(window, wanted)[-limit:]
+    missing = limit - len(part)
+    if missing > 0:
+        ceiling = window[0].msg.seq if window else _seq + 1
+        part = store.between(seq, ceiling, missing, channels) + part
+    return part
+
+
+async def wait_committed():
+    """
+    Con varios workers, espera a que estén escritos en SQLite todos los
+    mensajes ya difundidos (como mucho ``store.settle`` segundos). El aviso
+    en vivo de un mensaje puede salir antes de que se suscriba un cliente y
+    de que su worker lo escriba: si tampoco estuviera en el hueco que se le
+    envía, no lo recibiría nunca.
+    :return:
+    """
+    if not CLUSTER:
+        return
+    target = _seq
+    deadline = time.monotonic() + store.settle
+    while store.committed_seq() < target and time.monotonic() < deadline:
+        await asyncio.sleep(HISTORY_BATCH_MS / 1000)
+
+
+def history_oldest_since(seq, limit, channels=None):
+    """
+    Devuelve los ``limit`` mensajes *más antiguos* con secuencia mayor que
+    ``seq``, en orden cronológico, para que un cliente que va por detrás los
+    reciba todos en varias peticiones. Salen de la caché si la contiene
+    entera desde ``seq``; si no, de SQLite.
+    :param seq:
+    :param limit:
+    :param channels: Canales a incluir, o None para todos
+    :return:
+    """
+    cache, wanted = _cache_for(channels)
+    if cache is not None:
+        oldest = cache.oldest()
+        if oldest is not None and oldest.msg.seq <= seq + 1:
+            if wanted is None:
+                return cache.first_after(seq, limit)
+            return _only(cache.after(seq, cache.capacity), wanted)[:limit]
+    return store.after(seq, limit, channels)
+
+
+def seq_before_ts(ts):
+    """
+    Devuelve el número de secuencia del último mensaje anterior a ``ts``.
+    :param ts:
+    :return:
+    """
+    if not CLUSTER:
+        # Con varios workers la caché no se usa (ver _cache_for)
+        part = RECEIVED.before(ts, 1, key=attrgetter("msg.ts"))
+        if part:
+            return part[0].msg.seq
+    return store.seq_before_ts(ts)
+
+
+# Ingesta MQTT
+def ingest(topic, payload):
+    """
+    Procesa un mensaje MQTT recibido en un topic suscrito. En modo ``thread``
+    se llama desde el hilo de paho; en modo ``asyncio``, desde el event loop.
+    :param topic:
+    :param payload:
+    :return:
+    """
+    if topic == MQTT_TOPIC_EVENTS:
+        deliver_event(payload)
+        return
+    if topic == EVENTS_DOWNLINK:
+        event = StatusEvent.from_json(payload)
+        hub.publish_threadsafe(event, event.status.channel)
+        return
+    if topic == MQTT_TOPIC_STATUS:
+        bridge_status(payload)
+        return
+    start = time.perf_counter()
+    channel = layout.channel_of(topic)
+    if channel is None:
+        metrics.INGEST_ERRORS.labels("unknown_topic").inc()
+        logger.warning(f"Ignoring message on unknown topic: {topic}")
+        return
+    up = decode_uplink(payload)
+    key = uplink_key(up.sender, up.id, up.message)
+    if merger is not None and up.gw is not None and merger.merge(key, up.gw):
+        # Copia de otro puente dentro de la ventana
+        metrics.INGEST_MERGED.inc()
+        return
+    if seen is not None and seen.check(key):
+        metrics.INGEST_DUPLICATES.inc()
+        logger.info(f"Dropped duplicate message from {up.sender} on topic: {topic}")
+        return
+    trace = Trace.from_stamps(up.trace, time.time())
+    latency.ingested(trace)
+    if merger is not None and up.gw is not None:
+        merger.open(key, (topic, up, channel, trace), up.gw)
+    else:
+        save_uplink((topic, up, channel, trace), (up.gw,) if up.gw is not None else None)
+    metrics.INGEST_SECONDS.observe(time.perf_counter() - start)
+
+
+def save_uplink(item, gateways):
+    """
+    Guarda y difunde un uplink, con los puentes que lo recibieron.
+    :param item: (topic, Uplink, canal, Trace)
+    :param gateways:
+    :return:
+    """
+    topic, up, channel, trace = item
+    record = store_message(topic, up.message, up.sender, channel, trace, gateways)
+    metrics.INGEST_MESSAGES.inc()
+    logger.info(f"Received message {record.msg.seq} from {up.sender} on topic: {topic}")
+
+
+def bridge_status(payload):
+    """
+    Procesa un informe del puente sobre un mensaje de bajada (transmitido o
+    fallido).
+    :param payload:
+    :return:
+    """
+    report = decode_report(payload)
+    if report is None:
+        metrics.INGEST_ERRORS.labels("invalid_status").inc()
+        logger.warning(f"Ignoring invalid bridge status report: {payload[:100]!r}")
+        return
+    tracker.advance(report.dl, report.state, gateway=report.gw)
+
+
+def emit_status(event):
+    """
+    Difunde un cambio de estado de un mensaje de bajada. Con varios workers
+    pasa por ``EVENTS_DOWNLINK`` para llegar a los clientes de todos.
+    :param event: StatusEvent
+    :return:
+    """
+    if CLUSTER:
+        broker.publish_nowait(EVENTS_DOWNLINK, event.json)
+    else:
+        hub.publish_threadsafe(event, event.status.channel)
+
+
+# Límite de publicación por cliente. Cada worker tiene sus propios cubos,
+# así que el ritmo se reparte entre ellos como el del planificador.
+limiter = AirtimeLimiter(
+    Limit(RATE_LIMIT_AIRTIME / API_WORKERS, RATE_LIMIT_BURST),
+    {client: Limit(limit.rate / API_WORKERS, limit.burst)
+     for client, limit in parse_limits(RATE_LIMIT_CLIENTS).items()})
+
+# Estado de entrega de los mensajes de bajada. Con varios workers cada uno
+# sigue los que publica él (los informes y ACK llegan a todos).
+tracker = DownlinkTracker(emit_status, DOWNLINK_TRACK_MAX, LATENCY_WINDOW)
+
+# Combinación de copias de varios puentes (desactivada con MERGE_WINDOW=0)
+merger = MergeWindow(MERGE_WINDOW, save_uplink) if MERGE_WINDOW > 0 else None
+
+# Abrir el histórico y continuar la numeración donde se quedó
+store.open()
+_seq = store.last_seq()
+if not CLUSTER:
+    RECEIVED.extend(store.page(HISTORY_CACHE, _seq + 1))
+
+# Métricas del estado en memoria, leídas en cada scrape
+metrics.register_hub(hub)
+metrics.gauge("lorachat_history_messages", "Mensajes en el histórico (última secuencia)", lambda: _seq)
+if not CLUSTER:
+    metrics.gauge("lorachat_history_cache_messages", "Mensajes en la caché de recientes", lambda: len(RECEIVED))
+    metrics.gauge("lorachat_history_channel_caches", "Canales con caché propia", lambda: len(CHANNEL_CACHE))
+metrics.gauge("lorachat_history_pending_writes", "Mensajes pendientes de escribir en SQLite", store.pending)
+metrics.gauge("lorachat_downlinks_tracked", "Mensajes de bajada con estado en memoria", lambda: len(tracker))
+metrics.gauge("lorachat_rate_limit_clients", "Clientes con cubo de fichas en memoria", lambda: len(limiter))
+metrics.gauge("lorachat_longpoll_waiting", "Peticiones esperando en /messages/wait", lambda: len(waiters))
+if merger is not None:
+    metrics.gauge("lorachat_merge_pending", "Uplinks esperando copias de otros puentes", lambda: len(merger))
+if seen is not None:
+    metrics.gauge("lorachat_dedupe_keys", "Uplinks recordados para descartar duplicados", lambda: len(seen))
+
+# Crear cliente MQTT (se conecta al arrancar la aplicación). Con varios
+# workers cada uplink llega a uno solo, que lo guarda y lo reenvía a todos.
+if CLUSTER:
+    topics = ([f"$share/{MQTT_SHARED_GROUP}/{t}" for t in layout.subscriptions()]
+              + [MQTT_TOPIC_EVENTS, EVENTS_DOWNLINK, MQTT_TOPIC_STATUS])
+else:
+    topics = layout.subscriptions() + [MQTT_TOPIC_STATUS]
+broker = create_broker(MQTT_CLIENT_MODE, MQTT_BROKER, MQTT_PORT, topics, ingest,
+                       inflight=MQTT_INFLIGHT, backoff=Backoff(MQTT_RECONNECT_MIN, MQTT_RECONNECT_MAX))
+metrics.gauge("lorachat_mqtt_ready", "1 si el cliente MQTT está conectado y suscrito", lambda: broker.ready)
 
 # Endpoints
 @app.get("/")
@@ -99,53 +522,675 @@ async def root():
     """
     return {"status": "ok"}
 
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Sonda de vida: el proceso atiende peticiones. No depende del broker, así
+    que una caída de Mosquitto no provoca reinicios de la API.
+    :return:
+    """
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Sonda de disponibilidad: 200 si el cliente MQTT está conectado y con sus
+    suscripciones activas, 503 si no.
+    :return:
+    """
+    status = {"ready": broker.ready, "mqtt": {"connected": broker.connected, "subscribed": broker.ready}}
+    return JSONResponse(status, status_code=200 if broker.ready else 503)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Métricas en formato de texto de Prometheus.
+    :return:
+    """
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+
+@app.get("/latency")
+async def get_latency():
+    """
+    Percentiles móviles (p50, p95, p99, en ms) de la latencia de cada tramo
+    de los mensajes de subida, de la radio del puente al envío al cliente.
+    :return:
+    """
+    return {"window": LATENCY_WINDOW, "hops": latency.summary()}
+
+
+def channels_param(channels):
+    """
+    Valida el parámetro ``channels`` (lista separada por comas).
+    :param channels:
+    :return: Conjunto de canales, o None para todos
+    """
+    try:
+        return parse_channels(channels)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def messages_etag(selected, *params):
+    """
+    ETag de una página de ``/messages/``: la base de datos, el último número
+    de secuencia y los parámetros de la consulta. Mientras no llegue ningún
+    mensaje la página no cambia. Con varios workers la página sale de
+    SQLite, donde un worker puede escribir el 11 antes de que otro escriba
+    el 10: mientras quede un hueco así la página está incompleta y no se
+    da ETag, para que el cliente no la conserve con un 304.
+    :param selected: Canales de la consulta
+    :param params: Resto de parámetros
+    :return: El ETag, o None si la página aún puede cambiar sin mensajes nuevos
+    """
+    if not CLUSTER:
+        last = _seq
+    else:
+        last = store.committed_seq()
+        if store.last_seq() != last:
+            return None
+    query = repr((sorted(selected) if selected is not None else None, *params)).encode()
+    return f'W/"{store.epoch:x}-{last}-{zlib.crc32(query):08x}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Indica si la cabecera ``If-None-Match`` incluye ``etag``.
+    :param if_none_match:
+    :param etag:
+    :return:
+    """
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # Comparación débil: W/"x" y "x" son equivalentes
+    opaque = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque for tag in if_none_match.split(","))
+
+
 @app.get("/messages/")
-async def get_messages(limit: int = 20, offset: int = 0):
+@metrics.timed("messages")
+async def get_messages(limit: int = 20, offset: int = 0,
+                       before: int | None = None, until: float | None = None,
+                       channels: str | None = None,
+                       if_none_match: str | None = Header(None)):
     """
     Devuelve 'limit' mensajes *anteriores* al índice 'offset'
     (0 = el más reciente). Sirve para paginación inversa.
+
+    Para paginar sin saltos mientras llegan mensajes nuevos se puede usar
+    ``before`` (número de secuencia) o ``until`` (marca de tiempo) como cursor
+    en lugar de ``offset``. Con ``channels=a,b`` solo se devuelven mensajes
+    de esos canales.
+
+    La respuesta lleva un ``ETag``; si el cliente lo envía en
+    ``If-None-Match`` y no ha llegado ningún mensaje, la respuesta es 304
+    sin cuerpo y sin consultar el histórico. Con varios workers no lleva
+    ``ETag`` mientras haya mensajes pendientes de escribir entre los ya
+    escritos.
     """
-    total = len(RECEIVED)
-    start = max(total - offset - limit, 0)
-    end   = total - offset
-    msgs  = list(RECEIVED)[start:end]
-    return {"count": total, "messages": msgs}
+    selected = channels_param(channels)
+    etag = messages_etag(selected, limit, offset, before, until)
+    headers = {"Cache-Control": "no-cache"}
+    if etag is not None:
+        headers["ETag"] = etag
+    if etag is not None and etag_matches(if_none_match, etag):
+        metrics.NOT_MODIFIED.inc()
+        return Response(status_code=304, headers=headers)
+    total = _seq
+    if before is None:
+        before = total - offset + 1
+    if until is not None:
+        before = min(before, seq_before_ts(until) + 1)
+    msgs = history_page(limit, before, selected)
+    # Respuesta construida con el JSON ya codificado de cada mensaje
+    body = b'{"count":%d,"messages":%s}' % (total, encode_list(msgs))
+    return Response(body, media_type="application/json", headers=headers)
 
 
-@app.post("/publish/")
-async def publish_message(payload: PublishPayload):
+@app.get("/messages/wait")
+async def wait_messages(after: int, timeout: float = 30, limit: int = 100, channels: str | None = None):
     """
-    Endpoint para publicar un mensaje en el topic MQTT.
-    :param payload:
+    Long-polling para clientes sin WebSocket ni SSE. Devuelve en cuanto los
+    haya los mensajes posteriores a ``after`` (como máximo ``limit``, los más
+    antiguos primero); si no llega ninguno en ``timeout`` segundos, la lista
+    va vacía. ``last`` es el valor de ``after`` para la siguiente petición.
+    :param after: Último número de secuencia que el cliente ya tiene
+    :param timeout: Segundos máximos de espera (hasta ``LONGPOLL_TIMEOUT_MAX``)
+    :param limit: Máximo de mensajes (hasta ``WS_REPLAY_MAX``)
+    :param channels: Canales separados por comas (todos si se omite)
+    :return:
+    """
+    selected = channels_param(channels)
+    if after > _seq:
+        # El histórico se ha borrado y la numeración volvió a empezar
+        after = 0
+    limit = max(1, min(limit, WS_REPLAY_MAX))
+    deadline = time.monotonic() + max(0.0, min(timeout, LONGPOLL_TIMEOUT_MAX))
+    while True:
+        msgs = history_oldest_since(after, limit, selected)
+        remaining = deadline - time.monotonic()
+        if msgs or remaining <= 0:
+            break
+        if waiters.newest(selected) > after:
+            # Avisado por otro worker pero aún en su lote de escritura de SQLite
+            await asyncio.sleep(min(HISTORY_BATCH_MS / 1000, remaining))
+            continue
+        if not await waiters.wait(after, selected, remaining):
+            msgs = []
+            break
+    last = msgs[-1].msg.seq if msgs else after
+    body = b'{"last":%d,"messages":%s}' % (last, encode_list(msgs))
+    return Response(body, media_type="application/json")
+
+
+@app.get("/messages/search")
+@metrics.timed("search")
+async def search_messages(q: str, limit: int = 20, cursor: str | None = None,
+                          order: Literal["rank", "recent"] = "rank", sender: str | None = None,
+                          since: float | None = None, until: float | None = None,
+                          channels: str | None = None):
+    """
+    Busca mensajes por texto en todo el histórico. Todas las palabras de
+    ``q`` deben aparecer en el mensaje o en su remitente (sin distinguir
+    mayúsculas ni tildes); ``palabra*`` busca por prefijo.
+
+    Los resultados salen por relevancia (``order=rank``) o del más reciente
+    al más antiguo (``order=recent``), y se pueden limitar a un remitente
+    (``sender``), a un intervalo de tiempo (``since`` ≤ ts < ``until``) y a
+    unos canales. Para la página siguiente se pasa como ``cursor`` el valor
+    ``next`` de la respuesta, que es null en la última.
+    """
+    selected = channels_param(channels)
+    match = match_expression(q)
+    if match is None:
+        raise HTTPException(status_code=400, detail="Empty search query")
+    position = _parse_cursor(cursor, order) if cursor is not None else None
+    if position is None and order == "rank":
+        # La relevancia cambia con cada mensaje nuevo: las páginas siguientes
+        # ordenan solo lo que ya estaba escrito al pedir la primera
+        position = (await asyncio.to_thread(store.committed_seq), 0)
+    limit = max(1, min(limit, SEARCH_LIMIT_MAX))
+    results = await asyncio.to_thread(store.search, match, limit, position, order, sender, since, until, selected)
+    next_cursor = None
+    if len(results) == limit:
+        if order == "recent":
+            next_cursor = str(results[-1][0].msg.seq)
+        else:
+            snapshot, offset = position
+            next_cursor = f"{snapshot}:{offset + limit}"
+    body = b'{"messages":%s,"next":%s}' % (encode_list([r for r, _ in results]), encode(next_cursor))
+    return Response(body, media_type="application/json")
+
+
+def _parse_cursor(cursor, order):
+    """
+    Convierte el cursor de ``/messages/search`` en la posición que espera
+    ``store.search``.
+    :param cursor:
+    :param order:
     :return:
     """
+    try:
+        if order == "recent":
+            return int(cursor)
+        snapshot, offset = cursor.split(":")
+        return int(snapshot), int(offset)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def send_downlink(message, channel=DEFAULT_CHANNEL, dl_id=None):
+    """
+    Publica un mensaje de bajada en el topic de su canal y, cuando el broker
+    lo confirma, lo guarda y lo difunde. Lanza ``asyncio.TimeoutError`` o
+    ``ConnectionError`` si el broker no lo confirma.
+    :param message:
+    :param channel:
+    :param dl_id: Identificador con el que se sigue su entrega, o None
+    :return: (paquete publicado, mensaje guardado)
+    """
     out = {
         "from": "sent",
-        "message": payload.message
+        "message": message
     }
-    json_msg = json.dumps(out)
-    mqtt.publish(MQTT_TOPIC_DOWN, json_msg)
-    RECEIVED.append({
-        "topic": MQTT_TOPIC_DOWN,
-        "payload": payload.message,
-        "source": "sent"
-    })
-    return {"published": out}
+    topic = layout.down_topic(channel)
+    data = encode_downlink("sent", message, channel in BINARY_CHANNELS, int(time.time() * 1000), dl_id)
+    start = time.perf_counter()
+    try:
+        await asyncio.wait_for(broker.publish(topic, data, MQTT_QOS), MQTT_PUBLISH_TIMEOUT)
+    except asyncio.TimeoutError:
+        metrics.DOWNLINKS.labels("timeout").inc()
+        tracker.advance(dl_id, FAILED)
+        raise
+    except ConnectionError:
+        metrics.DOWNLINKS.labels("error").inc()
+        tracker.advance(dl_id, FAILED)
+        raise
+    metrics.MQTT_PUBLISH_ACK_SECONDS.observe(time.perf_counter() - start)
+    metrics.DOWNLINKS.labels("ok").inc()
+    record = store_message(topic, message, "sent", channel)
+    tracker.advance(dl_id, BROKERED, seq=record.msg.seq)
+    return out, record
+
+
+def new_downlink_id():
+    """
+    Identificador para un mensaje de bajada nuevo. El contador está en SQLite
+    para que no se repita entre reinicios ni entre workers: un ACK tardío
+    nunca confirma un mensaje que no es el suyo.
+    :return:
+    """
+    return store.allocate("downlink")
+
+
+def downlink_airtime(message, dl_id=None):
+    """
+    Tiempo en el aire, en segundos, de la trama que el puente transmitirá.
+    :param message:
+    :param dl_id: Identificador que viaja en la trama
+    :return:
+    """
+    length = downlink_frame_length(message, dl_id)
+    return time_on_air(length, LORA_SPREADING_FACTOR, LORA_BANDWIDTH, LORA_CODING_RATE, LORA_PREAMBLE) / 1e6
+
+
+async def send_queued(item):
+    """
+    Publica un mensaje liberado por el planificador.
+    :param item: (identificador, PublishPayload)
+    :return:
+    """
+    dl_id, payload = item
+    await send_downlink(payload.message, payload.channel, dl_id)
+
+
+def queued_airtime(item):
+    """
+    Tiempo en el aire de un mensaje encolado en el planificador.
+    :param item: (identificador, PublishPayload)
+    :return:
+    """
+    dl_id, payload = item
+    return downlink_airtime(payload.message, dl_id)
+
+
+# Planificador de bajada (desactivado con LORA_DUTY_CYCLE=0). Es uno solo
+# para todos los canales: si comparten radio, comparten presupuesto.
+scheduler = None
+if LORA_DUTY_CYCLE > 0:
+    # Cada worker tiene su propia cola: el presupuesto se reparte entre ellos
+    scheduler = DownlinkScheduler(send_queued, queued_airtime, LORA_DUTY_CYCLE / API_WORKERS,
+                                  DOWNLINK_QUEUE_MAX)
+    metrics.gauge("lorachat_downlink_queue", "Mensajes de bajada en cola", lambda: len(scheduler))
+
+
+def admit(request, items):
+    """
+    Cobra al cliente el tiempo en el aire de los mensajes que quiere
+    publicar, uno a uno y en orden, con la trama que se transmitirá (su
+    identificador incluido). Un lote mayor que la ráfaga del cliente se
+    admite hasta donde llegan sus fichas. Si no se admite ninguno responde
+    429 con ``Retry-After``, o 413 si el primero supera su ráfaga máxima.
+    :param request:
+    :param items: Lista de (identificador, PublishPayload)
+    :return: (mensajes admitidos, segundos hasta poder enviar el siguiente)
+    """
+    key = request.headers.get("x-api-key")
+    client = key if key in limiter.overrides else request.client.host if request.client else "unknown"
+    for admitted, item in enumerate(items):
+        wait = limiter.acquire(client, queued_airtime(item))
+        if wait > 0:
+            break
+    else:
+        return len(items), 0.0
+    metrics.RATE_LIMITED.inc()
+    if admitted == 0:
+        if wait == math.inf:
+            raise HTTPException(status_code=413, detail="Airtime exceeds the client's burst limit")
+        raise HTTPException(status_code=429, detail="Airtime limit exceeded",
+                            headers={"Retry-After": str(math.ceil(wait))})
+    return admitted, wait
+
+
+def rate_limited(item, wait):
+    """
+    Resultado de un mensaje de un lote que no se admitió.
+    :param item: (identificador, PublishPayload)
+    :param wait: Segundos hasta que el cliente tenga fichas suficientes
+    :return:
+    """
+    _, payload = item
+    if wait == math.inf:
+        return {"message": payload.message, "error": "Airtime exceeds the client's burst limit"}
+    return {"message": payload.message, "error": "Airtime limit exceeded", "retry_after": math.ceil(wait)}
+
+
+def enqueue_downlink(item):
+    """
+    Encola un mensaje en el planificador y describe su posición.
+    :param item: (identificador, PublishPayload)
+    :return:
+    """
+    dl_id, payload = item
+    position, eta, airtime = scheduler.submit(item)
+    tracker.create(dl_id, payload.channel)
+    return {"id": dl_id, "message": payload.message, "channel": payload.channel, "position": position,
+            "eta": eta, "airtime_ms": round(airtime * 1000, 1)}
+
+
+@app.post("/publish/")
+@metrics.timed("publish")
+async def publish_message(payload: PublishPayload, request: Request):
+    """
+    Endpoint para publicar un mensaje en el topic MQTT.
+
+    Con el control de ciclo de trabajo activo el mensaje se encola y la
+    respuesta es 202 con su posición en la cola y la hora estimada de envío.
+    Sin él, responde cuando el broker confirma la publicación. Cada cliente
+    tiene un presupuesto de tiempo en el aire (``RATE_LIMIT_*``); al agotarlo
+    la respuesta es 429.
+    :param payload:
+    :param request:
+    :return:
+    """
+    # Con la cola llena no se cobra el mensaje: el cliente lo reintentará
+    if scheduler is not None and len(scheduler) >= scheduler.maxsize:
+        raise HTTPException(status_code=503, detail="Downlink queue is full")
+    dl_id = new_downlink_id()
+    admit(request, [(dl_id, payload)])
+    if scheduler is not None:
+        return JSONResponse(enqueue_downlink((dl_id, payload)), status_code=202)
+    tracker.create(dl_id, payload.channel)
+    try:
+        out, record = await send_downlink(payload.message, payload.channel, dl_id)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="MQTT broker did not acknowledge the message")
+    except ConnectionError as e:
+        raise HTTPException(status_code=503, detail=f"MQTT publish failed: {e}")
+    return {"id": dl_id, "published": out, "channel": payload.channel, "seq": record.msg.seq}
+
+
+@app.post("/publish/batch")
+@metrics.timed("publish_batch")
+async def publish_batch(payloads: list[PublishPayload], request: Request):
+    """
+    Publica varios mensajes en una sola petición. Se mantienen como máximo
+    ``MQTT_INFLIGHT`` publicaciones QoS 1 sin confirmar a la vez, y la
+    respuesta llega cuando el broker ha confirmado (o rechazado) cada una.
+
+    Con el control de ciclo de trabajo activo los mensajes se encolan en el
+    planificador y la respuesta es 202 con la posición y ETA de cada uno.
+    Cada mensaje se cobra al presupuesto de tiempo en el aire del cliente:
+    si se agota a mitad del lote, el resto no se publica, su resultado
+    lleva ``error`` y ``retry_after`` y la respuesta ``Retry-After``.
+    :param payloads: Lista de mensajes, en orden de envío
+    :param request:
+    :return: Un resultado por mensaje, en el mismo orden
+    """
+    if len(payloads) > PUBLISH_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"Batch larger than {PUBLISH_BATCH_MAX} messages")
+    if scheduler is not None and len(scheduler) + len(payloads) > scheduler.maxsize:
+        raise HTTPException(status_code=503, detail="Downlink queue is full")
+    items = [(new_downlink_id(), p) for p in payloads]
+    admitted, wait = admit(request, items)
+    rejected = [rate_limited(item, wait) for item in items[admitted:]]
+    headers = {"Retry-After": str(math.ceil(wait))} if rejected and wait != math.inf else None
+    if scheduler is not None:
+        results = [enqueue_downlink(item) for item in items[:admitted]]
+        return JSONResponse({"queued": len(results), "results": results + rejected}, status_code=202,
+                            headers=headers)
+    window = asyncio.Semaphore(MQTT_INFLIGHT)
+
+    async def publish_one(item):
+        dl_id, payload = item
+        tracker.create(dl_id, payload.channel)
+        async with window:
+            try:
+                _, record = await send_downlink(payload.message, payload.channel, dl_id)
+            except asyncio.TimeoutError:
+                return {"id": dl_id, "message": payload.message, "published": False, "error": "timeout"}
+            except ConnectionError as e:
+                return {"id": dl_id, "message": payload.message, "published": False, "error": str(e)}
+        return {"id": dl_id, "message": payload.message, "published": True, "seq": record.msg.seq}
+
+    results = await asyncio.gather(*(publish_one(item) for item in items[:admitted]))
+    return JSONResponse({"published": sum(r["published"] for r in results), "results": results + rejected},
+                        headers=headers)
+
+@app.get("/downlinks")
+async def get_downlinks():
+    """
+    Resumen de la entrega de los mensajes de bajada recientes: cuántos han
+    alcanzado cada estado, proporción confirmada por un nodo (ACK) entre los
+    publicados y percentiles (ms) del tiempo hasta cada estado.
+    :return:
+    """
+    return tracker.summary()
+
+
+@app.get("/downlinks/{dl_id}")
+async def get_downlink(dl_id: int):
+    """
+    Estado de un mensaje de bajada, con la hora a la que alcanzó cada estado.
+    :param dl_id: Identificador devuelto por ``/publish/``
+    :return:
+    """
+    item = tracker.get(dl_id)
+    if item is None:
+        raise HTTPException(status_code=404, detail="Unknown downlink")
+    return item
+
+
+DELIVERY_WS = metrics.DELIVERY_SECONDS.labels("ws")
+DELIVERY_SSE = metrics.DELIVERY_SECONDS.labels("sse")
+
+
+def delivered(item, histogram):
+    """
+    Registra la latencia de un mensaje enviado a un cliente. Los eventos de
+    estado de la bajada no cuentan.
+    :param item:
+    :param histogram: Histograma de entrega del transporte
+    :return:
+    """
+    if item.msg is None:
+        return
+    now = time.time()
+    histogram.observe(now - item.msg.ts)
+    if item.trace is not None:
+        latency.delivered(item.trace, now)
+
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, since: int | None = None, history: int | None = None,
+                             channels: str | None = None):
     """
-    Endpoint WebSocket para recibir mensajes en tiempo real.
+    Endpoint WebSocket para recibir mensajes en tiempo real. Cada mensaje
+    nuevo llega desde el hub en cuanto se recibe; no hay sondeo periódico.
+
+    Con ``since=<seq>`` el cliente recibe primero, en un único frame (una
+    lista JSON), todos los mensajes posteriores a ``seq`` que sigan en el
+    buffer, y después pasa al envío en vivo sin huecos ni duplicados. Con
+    ``history=N`` (y sin ``since``) ese primer frame trae los ``N`` mensajes
+    más recientes, de modo que un cliente nuevo no necesita pedir el
+    histórico a ``/messages/`` antes de conectarse.
+
+    Con ``channels=a,b`` el cliente solo recibe mensajes de esos canales.
+
+    El cliente puede negociar el subprotocolo ``lorachat.msgpack``: los
+    frames pasan a ser binarios en MessagePack y, en vivo, los mensajes que
+    se acumulan en la cola del cliente salen juntos en un solo frame (una
+    lista). Sin subprotocolo, o con ``lorachat.json``, los frames son JSON.
+    La compresión permessage-deflate la negocia uvicorn si el cliente la
+    ofrece (``UVICORN_WS_PER_MESSAGE_DEFLATE=false`` la desactiva).
     :param websocket:
+    :param since: Último número de secuencia que el cliente ya tiene
+    :param history: Mensajes recientes a enviar al conectar (máx. ``WS_REPLAY_MAX``)
+    :param channels: Canales separados por comas (todos si se omite)
     :return:
     """
-    await websocket.accept()
-    clients.append(websocket)
     try:
+        selected = parse_channels(channels)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    offered = websocket.scope.get("subprotocols", [])
+    subprotocol = next((p for p in offered if p in (SUBPROTOCOL_JSON, SUBPROTOCOL_MSGPACK)), None)
+    await websocket.accept(subprotocol=subprotocol)
+    binary = subprotocol == SUBPROTOCOL_MSGPACK
+    # Suscribirse antes de tomar la instantánea: lo que llegue mientras se
+    # envía el hueco queda en la cola y se filtra por número de secuencia.
+    sub = hub.subscribe(selected)
+    watcher = asyncio.create_task(_watch_disconnect(websocket, sub))
+    if since is not None and since > _seq:
+        # El histórico se ha borrado y la numeración volvió a empezar
+        since = 0
+    replayed = set()
+    try:
+        if since is not None or history is not None:
+            await wait_committed()
+            if since is not None:
+                gap = history_since(since, channels=selected)
+            else:
+                gap = history_page(min(history, WS_REPLAY_MAX), _seq + 1, selected)
+            if binary:
+                await websocket.send_bytes(encode_list_msgpack(gap))
+            else:
+                await websocket.send_text(encode_list(gap).decode())
+            replayed = {r.msg.seq for r in gap}
         while True:
-            await asyncio.sleep(1)
-            if RECEIVED:
-                last_msg = RECEIVED[-1]
-                await websocket.send_json(last_msg)
-    except:
-        clients.remove(websocket)
\ No newline at end of file
+            item = await sub.queue.get()
+            if item is None:
+                if not watcher.done():
+                    # Cliente demasiado lento, expulsado por el hub
+                    await websocket.close(code=1013)
+                break
+            if binary:
+                batch = [i for i in _drain(sub, item, WS_BATCH_MAX) if not _already_sent(i, since, replayed)]
+                if not batch:
+                    continue
+                await websocket.send_bytes(batch[0].msgpack if len(batch) == 1 else encode_list_msgpack(batch))
+                for i in batch:
+                    delivered(i, DELIVERY_WS)
+                continue
+            if _already_sent(item, since, replayed):
+                continue
+            await websocket.send_text(item.text)
+            delivered(item, DELIVERY_WS)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
+    finally:
+        watcher.cancel()
+        hub.unsubscribe(sub)
+
+
+def _drain(sub, first, limit):
+    """
+    Devuelve ``first`` junto con los mensajes que ya esperan en la cola del
+    suscriptor, hasta ``limit``. Si encuentra el centinela de cierre lo deja
+    en la cola para la siguiente vuelta.
+    :param sub:
+    :param first:
+    :param limit:
+    :return:
+    """
+    batch = [first]
+    while len(batch) < limit and not sub.queue.empty():
+        item = sub.queue.get_nowait()
+        if item is None:
+            sub.queue.put_nowait(None)
+            break
+        batch.append(item)
+    return batch
+
+
+def _already_sent(item, since, replayed):
+    """
+    Indica si un mensaje en vivo ya lo tiene el cliente. Se comprueba por
+    conjunto y no por el último número de secuencia porque, con varios
+    workers, los mensajes pueden llegar ligeramente desordenados.
+    :param item:
+    :param since: Secuencia que el cliente pidió, o None
+    :param replayed: Secuencias enviadas en el hueco
+    :return:
+    """
+    if item.msg is None:
+        # Evento de estado de la bajada: no forma parte del histórico
+        return False
+    seq = item.msg.seq
+    return (since is not None and seq <= since) or seq in replayed
+
+
+async def _watch_disconnect(websocket, sub):
+    """
+    Espera a que el cliente cierre el socket y despierta al bucle de envío,
+    que si no seguiría esperando mensajes nuevos.
+    :param websocket:
+    :param sub:
+    :return:
+    """
+    try:
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    except RuntimeError:
+        pass
+    sub.close()
+
+
+@app.get("/stream")
+async def stream(since: int | None = None, channels: str | None = None,
+                 last_event_id: str | None = Header(None)):
+    """
+    Flujo Server-Sent Events con los mensajes en tiempo real. Cada evento
+    lleva el número de secuencia como ``id``, así que al reconectar el
+    navegador envía ``Last-Event-ID`` y recibe solo lo que se perdió. Los
+    clientes que no pueden enviar cabeceras pueden usar ``since=<seq>``, y
+    ``channels=a,b`` limita el flujo a esos canales.
+    Cada ``SSE_HEARTBEAT`` segundos sin mensajes se envía un comentario para
+    que los proxies no cierren la conexión.
+    :param since: Último número de secuencia que el cliente ya tiene
+    :param channels: Canales separados por comas (todos si se omite)
+    :param last_event_id: Cabecera ``Last-Event-ID`` del navegador
+    :return:
+    """
+    selected = channels_param(channels)
+    if last_event_id is not None and last_event_id.isdigit():
+        since = int(last_event_id)
+    if since is not None and since > _seq:
+        since = 0
+    sub = hub.subscribe(selected)
+
+    async def events():
+        try:
+            yield b"retry: 3000\n: connected\n\n"
+            replayed = set()
+            if since is not None:
+                await wait_committed()
+                gap = history_since(since, channels=selected)
+                if gap:
+                    yield b"".join(r.sse for r in gap)
+                replayed = {r.msg.seq for r in gap}
+            while True:
+                try:
+                    item = await asyncio.wait_for(sub.queue.get(), SSE_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                if item is None:
+                    break
+                if _already_sent(item, since, replayed):
+                    continue
+                delivered(item, DELIVERY_SSE)
+                yield item.sse
+        finally:
+            hub.unsubscribe(sub)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
@@ -0,0 +1,97 @@
+"""
+Combinación de las copias de un uplink oídas por varios puentes.
+
+Cuando dos puentes oyen el mismo paquete LoRa, cada uno lo publica. La
+primera copia abre una ventana corta; las que llegan dentro de ella solo
+añaden su puente (con su RSSI y SNR) a la lista de la primera. Al cerrar la
+ventana el mensaje se guarda y se difunde una única vez con todos los
+puentes que lo recibieron, ordenados de mejor a peor señal.
+"""
+import threading
+
+
+class MergeWindow:
+    """
+    Copias pendientes de combinar, por clave de uplink.
+    """
+
+    def __init__(self, window, flush):
+        """
+        :param window: Segundos que se esperan otras copias tras la primera
+        :param flush: ``flush(item, gateways)``, llamado al cerrar la ventana (en el event loop
+            salvo que no haya ninguno asociado)
+        """
+        self.window = window
+        self.flush = flush
+        self._pending = {}             # clave -> (item, {id de puente: Gateway})
+        self._lock = threading.Lock()
+        self.loop = None
+        self._loop_thread = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def bind(self, loop):
+        """
+        Asocia la ventana al event loop de la aplicación. Debe llamarse desde
+        el hilo del propio loop. Con ``None`` se cierran las ventanas abiertas.
+        :param loop:
+        :return:
+        """
+        if loop is None:
+            for key in list(self._pending):
+                self._close(key)
+        self.loop = loop
+        self._loop_thread = threading.get_ident() if loop is not None else None
+
+    def merge(self, key, gateway):
+        """
+        Añade el puente de una copia a la ventana abierta para ``key``.
+        :param key:
+        :param gateway: Gateway que envía la copia
+        :return: True si había una ventana abierta; False si la copia es la primera
+        """
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                return False
+            # Un reintento del mismo puente no cuenta dos veces
+            entry[1].setdefault(gateway.id, gateway)
+            return True
+
+    def open(self, key, item, gateway):
+        """
+        Abre la ventana de ``key`` con su primera copia.
+        :param key:
+        :param item: Lo que se entregará a ``flush`` al cerrar la ventana
+        :param gateway: Gateway de la primera copia
+        :return:
+        """
+        with self._lock:
+            self._pending[key] = (item, {gateway.id: gateway})
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            self._close(key)
+        elif threading.get_ident() == self._loop_thread:
+            loop.call_later(self.window, self._close, key)
+        else:
+            loop.call_soon_threadsafe(loop.call_later, self.window, self._close, key)
+
+    def _close(self, key):
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        if entry is None:
+            return
+        item, gateways = entry
+        ranked = sorted(gateways.values(), key=_signal, reverse=True)
+        self.flush(item, tuple(ranked))
+
+
+def _signal(gateway):
+    """
+    Clave de orden de un puente: primero el SNR y, a igualdad, el RSSI.
+    :param gateway:
+    :return:
+    """
+    return (gateway.snr if gateway.snr is not None else float("-inf"),
+            gateway.rssi if gateway.rssi is not None else float("-inf"))
@@ -0,0 +1,201 @@
+"""
+Tipos y codificación de los mensajes.
+
+Los paquetes MQTT se decodifican con un decodificador msgspec tipado y cada
+mensaje guardado se codifica a JSON una sola vez, al entrar. WebSocket y REST
+reutilizan después esos bytes en lugar de serializar el mensaje otra vez para
+cada cliente o cada respuesta. La versión MessagePack, para los clientes
+WebSocket que la negocian, se codifica también una sola vez, la primera vez
+que se necesita.
+"""
+import struct
+
+import msgspec
+
+from . import envelope
+from .metrics import INGEST_ERRORS
+
+UNKNOWN_SENDER = "desconocido"
+
+
+class Stamps(msgspec.Struct):
+    """
+    Marcas de tiempo del puente, en ms desde 1970: recepción LoRa y
+    publicación MQTT.
+    """
+    rx: int | None = None
+    pub: int | None = None
+
+
+class Gateway(msgspec.Struct, frozen=True, gc=False):
+    """
+    Puente que recibió un uplink y la señal con que lo oyó.
+    """
+    id: str
+    rssi: float | None = None
+    snr: float | None = None
+
+
+class Uplink(msgspec.Struct):
+    """
+    Paquete JSON publicado por el puente: ``{"from": ..., "message": ...}``,
+    opcionalmente con el número de mensaje del nodo (``id``), las marcas de
+    tiempo del puente (``trace``) y el propio puente con su señal (``gw``).
+    """
+    message: str | None = None
+    sender: str = msgspec.field(name="from", default=UNKNOWN_SENDER)
+    id: int | None = None
+    trace: Stamps | None = None
+    gw: Gateway | None = None
+
+
+class Message(msgspec.Struct, frozen=True, gc=False, omit_defaults=True):
+    """
+    Mensaje guardado en el histórico. Los uplinks llevan en ``gateways`` los
+    puentes que los recibieron, de mejor a peor señal.
+    """
+    seq: int
+    ts: float
+    topic: str
+    payload: str
+    source: str
+    channel: str
+    gateways: tuple[Gateway, ...] | None = None
+
+
+class Record:
+    """
+    Mensaje junto con su JSON, calculado una sola vez, y sus marcas de
+    tiempo de latencia (que no forman parte del JSON).
+    """
+    __slots__ = ("msg", "json", "text", "_sse", "_msgpack", "trace")
+
+    def __init__(self, msg, json=None, trace=None):
+        """
+        :param msg: Mensaje
+        :param json: JSON del mensaje si ya se tiene codificado
+        :param trace: latency.Trace del mensaje, si se mide
+        """
+        self.msg = msg
+        self.trace = trace
+        self.json = _encoder.encode(msg) if json is None else json
+        # Los frames de texto WebSocket necesitan str
+        self.text = self.json.decode()
+        self._sse = None
+        self._msgpack = None
+
+    @property
+    def sse(self):
+        """
+        Evento Server-Sent Events del mensaje, con su secuencia como ``id``.
+        Se construye la primera vez que se pide.
+        :return: bytes
+        """
+        if self._sse is None:
+            self._sse = b"id: %d\ndata: %s\n\n" % (self.msg.seq, self.json)
+        return self._sse
+
+    @property
+    def msgpack(self):
+        """
+        Mensaje codificado en MessagePack. Se construye la primera vez que se
+        pide.
+        :return: bytes
+        """
+        if self._msgpack is None:
+            self._msgpack = _msgpack_encoder.encode(self.msg)
+        return self._msgpack
+
+    @classmethod
+    def from_json(cls, raw):
+        """
+        Reconstruye un mensaje a partir de su JSON, reutilizando los bytes.
+        :param raw:
+        :return:
+        """
+        return cls(_message_decoder.decode(raw), bytes(raw))
+
+
+_uplink_decoder = msgspec.json.Decoder(Uplink)
+_message_decoder = msgspec.json.Decoder(Message)
+_encoder = msgspec.json.Encoder()
+_msgpack_encoder = msgspec.msgpack.Encoder()
+
+
+def decode_uplink(raw):
+    """
+    Decodifica un paquete MQTT, en sobre binario (``envelope``) o en JSON.
+    Si no es ninguno de los dos, el paquete completo se toma como texto.
+    :param raw: Bytes del paquete
+    :return: Uplink con ``message`` siempre relleno
+    """
+    if envelope.is_envelope(raw):
+        try:
+            sender, body, seq, ts, pub, gw = envelope.unpack(raw)
+        except envelope.EnvelopeError:
+            INGEST_ERRORS.labels("invalid_envelope").inc()
+            return Uplink(raw.decode(errors="replace"))
+        return Uplink(body, sender, seq,
+                      Stamps(ts, pub) if ts is not None or pub is not None else None,
+                      Gateway(*gw) if gw is not None else None)
+    try:
+        up = _uplink_decoder.decode(raw)
+    except msgspec.DecodeError:
+        INGEST_ERRORS.labels("invalid_json").inc()
+        return Uplink(raw.decode(errors="replace"))
+    if up.message is None:
+        INGEST_ERRORS.labels("missing_message").inc()
+        up.message = raw.decode(errors="replace")
+    return up
+
+
+def encode_downlink(sender, message, binary, ts=None, id=None):
+    """
+    Paquete MQTT de bajada, en sobre binario o en el JSON clásico.
+    :param sender:
+    :param message:
+    :param binary: True para el sobre binario
+    :param ts: Instante de envío en ms desde 1970 (solo en el sobre)
+    :param id: Identificador del mensaje de bajada (``downlinks``), o None
+    :return: bytes
+    """
+    if binary:
+        return envelope.pack(sender, message, seq=id, ts=ts)
+    if id is None:
+        return _encoder.encode({"from": sender, "message": message})
+    return _encoder.encode({"from": sender, "message": message, "id": id})
+
+
+def encode(obj):
+    """
+    Codifica un objeto cualquiera a JSON (bytes).
+    :param obj:
+    :return:
+    """
+    return _encoder.encode(obj)
+
+
+def encode_list(records):
+    """
+    Lista JSON con los mensajes ya codificados, sin volver a serializarlos.
+    :param records:
+    :return: bytes
+    """
+    return b"[" + b",".join(r.json for r in records) + b"]"
+
+
+def encode_list_msgpack(records):
+    """
+    Lista MessagePack con los mensajes ya codificados, sin volver a
+    serializarlos: solo se antepone la cabecera del array.
+    :param records:
+    :return: bytes
+    """
+    n = len(records)
+    if n < 16:
+        header = bytes((0x90 | n,))
+    elif n < 0x10000:
+        header = struct.pack(">BH", 0xDC, n)
+    else:
+        header = struct.pack(">BI", 0xDD, n)
+    return header + b"".join(r.msgpack for r in records)
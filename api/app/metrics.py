@@ -0,0 +1,132 @@
+"""
+Métricas Prometheus de la API.
+
+Los contadores e histogramas se actualizan en los caminos críticos (ingesta,
+difusión, publicación), donde cada operación cuesta poco más de un
+incremento con cerrojo. El estado que ya existe en memoria (clientes
+conectados, colas, tamaño del histórico) no se mantiene en paralelo: se lee
+en el momento del scrape.
+"""
+import functools
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+
+# Cubetas de latencia en segundos, de 100 µs a 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+INGEST_MESSAGES = Counter(
+    "lorachat_ingest_messages", "Mensajes MQTT de subida guardados")
+INGEST_ERRORS = Counter(
+    "lorachat_ingest_errors", "Paquetes MQTT de subida con problemas", ["reason"])
+INGEST_DUPLICATES = Counter(
+    "lorachat_ingest_duplicates", "Uplinks duplicados descartados")
+INGEST_MERGED = Counter(
+    "lorachat_ingest_merged", "Copias de uplinks de otros puentes combinadas con la primera")
+INGEST_SECONDS = Histogram(
+    "lorachat_ingest_seconds", "Tiempo de proceso de un mensaje de subida", buckets=LATENCY_BUCKETS)
+
+FANOUT_SECONDS = Histogram(
+    "lorachat_fanout_seconds", "Tiempo en encolar un mensaje para todos sus suscriptores",
+    buckets=LATENCY_BUCKETS)
+DELIVERY_SECONDS = Histogram(
+    "lorachat_delivery_seconds", "Tiempo desde que se guarda un mensaje hasta que sale por el socket",
+    ["transport"], buckets=LATENCY_BUCKETS)
+CLIENT_DROPPED = Counter(
+    "lorachat_client_dropped_messages", "Mensajes descartados por clientes lentos")
+CLIENT_KICKED = Counter(
+    "lorachat_client_disconnects_slow", "Clientes expulsados por lentos")
+
+MQTT_PUBLISH_ACK_SECONDS = Histogram(
+    "lorachat_mqtt_publish_ack_seconds", "Tiempo desde la publicación hasta la confirmación del broker",
+    buckets=LATENCY_BUCKETS)
+DOWNLINKS = Counter(
+    "lorachat_downlink_messages", "Mensajes de bajada publicados, por resultado", ["result"])
+RATE_LIMITED = Counter(
+    "lorachat_rate_limited_requests", "Peticiones de publicación rechazadas por el límite por cliente")
+DOWNLINK_STATE_SECONDS = Histogram(
+    "lorachat_downlink_state_seconds", "Tiempo desde que se encola un mensaje de bajada hasta cada estado",
+    ["state"], buckets=LATENCY_BUCKETS)
+
+HOP_SECONDS = Histogram(
+    "lorachat_hop_seconds", "Latencia de cada tramo de un mensaje de subida (ver latency.py)",
+    ["hop"], buckets=LATENCY_BUCKETS)
+
+REQUEST_SECONDS = Histogram(
+    "lorachat_request_seconds", "Duración de las peticiones HTTP", ["endpoint"], buckets=LATENCY_BUCKETS)
+NOT_MODIFIED = Counter(
+    "lorachat_not_modified_responses", "Consultas a /messages/ respondidas con 304 (sin cambios)")
+
+
+def timed(endpoint):
+    """
+    Decorador que mide la duración de un endpoint asíncrono en
+    ``lorachat_request_seconds``.
+    :param endpoint: Nombre de la etiqueta ``endpoint``
+    :return:
+    """
+    histogram = REQUEST_SECONDS.labels(endpoint)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def gauge(name, documentation, function):
+    """
+    Crea un gauge cuyo valor se calcula al hacer el scrape.
+    :param name:
+    :param documentation:
+    :param function: Función sin argumentos que devuelve el valor
+    :return:
+    """
+    g = Gauge(name, documentation)
+    g.set_function(function)
+    return g
+
+
+class SubscriberCollector:
+    """
+    Expone el número de clientes conectados y la profundidad de la cola de
+    cada uno, leyendo el hub en el momento del scrape.
+    """
+
+    def __init__(self, hub):
+        self.hub = hub
+
+    def collect(self):
+        subs = self.hub.all_subscribers()
+        clients = GaugeMetricFamily("lorachat_clients", "Clientes en tiempo real conectados")
+        clients.add_metric([], len(subs))
+        depth = GaugeMetricFamily("lorachat_client_queue_depth", "Mensajes pendientes en la cola de cada cliente",
+                                  labels=["client"])
+        for sub in subs:
+            depth.add_metric([str(sub.id)], sub.queue.qsize())
+        yield clients
+        yield depth
+
+
+def register_hub(hub):
+    """
+    Registra las métricas del hub.
+    :param hub:
+    :return:
+    """
+    REGISTRY.register(SubscriberCollector(hub))
+
+
+def render():
+    """
+    Métricas en formato de texto de Prometheus.
+    :return: (cuerpo, content type)
+    """
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
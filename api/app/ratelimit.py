@@ -0,0 +1,124 @@
+"""
+Control de admisión de ``/publish/`` por cliente.
+
+Cada cliente (su API key, si es una de las configuradas, o su IP) tiene un
+cubo de fichas (token bucket) medido en *segundos de tiempo en el aire*: un
+mensaje cuesta lo que tardará el puente en transmitirlo, así que un texto
+largo con SF12 gasta mucho más que un "ok" con SF7. El cubo se rellena a
+``rate`` segundos de aire por segundo (la fracción del canal que puede usar
+el cliente) hasta ``burst``.
+
+El estado de un cliente son dos números (fichas e instante de la última
+actualización). Se consulta y actualiza solo desde el event loop, sin
+cerrojos. Los clientes cuyo cubo ya estaría lleno se olvidan (equivalen a
+uno nuevo), de modo que la memoria es proporcional a los clientes activos.
+"""
+import math
+import time
+from collections import OrderedDict
+
+
+class Limit:
+    """
+    Límite de un cliente.
+    """
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, rate, burst):
+        """
+        :param rate: Segundos de aire por segundo (0 = sin límite)
+        :param burst: Segundos de aire que se pueden gastar de golpe
+        """
+        self.rate = rate
+        self.burst = burst
+
+    @property
+    def unlimited(self):
+        return self.rate <= 0
+
+
+def parse_limits(value):
+    """
+    Interpreta límites por cliente: ``cliente=rate:burst`` separados por
+    comas, donde ``cliente`` es una IP o una API key. ``rate`` 0 exime al
+    cliente del límite.
+    :param value:
+    :return: dict cliente -> Limit
+    """
+    limits = {}
+    if not value:
+        return limits
+    for entry in value.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            client, spec = entry.rsplit("=", 1)
+            rate, burst = spec.split(":")
+            limits[client.strip()] = Limit(float(rate), float(burst))
+        except ValueError:
+            raise ValueError(f"Invalid rate limit entry: {entry!r} (expected client=rate:burst)") from None
+    return limits
+
+
+class AirtimeLimiter:
+    """
+    Cubos de fichas por cliente.
+    """
+
+    def __init__(self, default, overrides=None, maxsize=100000):
+        """
+        :param default: Limit de los clientes sin límite propio
+        :param overrides: dict cliente -> Limit
+        :param maxsize: Máximo de clientes con estado; al superarlo se olvidan los más inactivos
+        """
+        self.default = default
+        self.overrides = overrides or {}
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # cliente -> [fichas, instante], del menos al más reciente
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def limit_for(self, client):
+        return self.overrides.get(client, self.default)
+
+    def _expire(self, now):
+        buckets = self._buckets
+        while buckets:
+            client, (tokens, stamp) = next(iter(buckets.items()))
+            limit = self.limit_for(client)
+            if limit.unlimited or stamp + (limit.burst - tokens) / limit.rate > now:
+                break
+            del buckets[client]
+
+    def acquire(self, client, cost):
+        """
+        Gasta ``cost`` segundos de aire del cubo de ``client`` si los tiene.
+        :param client:
+        :param cost: Tiempo en el aire de lo que se quiere publicar, en segundos
+        :return: 0 si se admite; si no, segundos hasta que haya fichas
+            suficientes (``math.inf`` si ``cost`` supera la ráfaga máxima)
+        """
+        limit = self.limit_for(client)
+        if limit.unlimited:
+            return 0.0
+        if cost > limit.burst:
+            return math.inf
+        now = time.monotonic()
+        self._expire(now)
+        bucket = self._buckets.get(client)
+        if bucket is None:
+            tokens = limit.burst
+        else:
+            tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+        if tokens < cost:
+            return (cost - tokens) / limit.rate
+        if bucket is None:
+            self._buckets[client] = [tokens - cost, now]
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            bucket[0], bucket[1] = tokens - cost, now
+            self._buckets.move_to_end(client)
+        return 0.0
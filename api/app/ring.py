@@ -0,0 +1,153 @@
+"""
+Buffer circular indexable con lectores sin bloqueo.
+
+Los escritores se serializan con un lock; los lectores nunca lo toman. Cada
+elemento ocupa una posición absoluta creciente y el buffer guarda las
+``capacity`` más recientes. Un lector toma el contador de escrituras, copia
+solo la ventana que necesita y comprueba al terminar que ningún escritor ha
+sobrescrito esa ventana mientras tanto; si ha ocurrido, repite la lectura.
+"""
+import threading
+
+
+class RingBuffer:
+    """
+    Buffer circular de tamaño fijo, ordenado por una clave creciente.
+    """
+
+    def __init__(self, capacity, key):
+        """
+        :param capacity: Número de elementos que se conservan
+        :param key: Función que devuelve la clave creciente de un elemento (p. ej. su número de secuencia)
+        """
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.key = key
+        # Un hueco extra: el escritor en curso nunca pisa la ventana válida
+        self._size = capacity + 1
+        self._slots = [None] * self._size
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, item):
+        """
+        Añade un elemento. Las claves deben llegar en orden creciente.
+        :param item:
+        :return:
+        """
+        with self._lock:
+            n = self._count
+            self._slots[n % self._size] = item
+            # Publicar la posición solo cuando el hueco ya está escrito
+            self._count = n + 1
+
+    def extend(self, items):
+        """
+        Añade varios elementos en orden.
+        :param items:
+        :return:
+        """
+        for item in items:
+            self.append(item)
+
+    def _read(self, fn):
+        """
+        Ejecuta ``fn(lo, hi)`` sobre la ventana válida [lo, hi) y repite si
+        un escritor ha sobrescrito alguna posición desde ``lo`` durante la
+        lectura.
+        :param fn:
+        :return:
+        """
+        while True:
+            hi = self._count
+            lo = max(hi - self.capacity, 0)
+            result = fn(lo, hi)
+            if lo >= self._count - self.capacity:
+                return result
+
+    def _slice(self, start, stop):
+        size = self._size
+        a, b = start % size, stop % size
+        if start >= stop:
+            return []
+        if a < b:
+            return self._slots[a:b]
+        return self._slots[a:] + self._slots[:b]
+
+    def _bisect(self, lo, hi, value, key, right=False):
+        # Primera posición en [lo, hi) con clave >= value (> value si right)
+        slots, size = self._slots, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            k = key(slots[mid % size])
+            if k < value or (right and k == value):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def first_after(self, value, limit):
+        """
+        Devuelve los ``limit`` elementos más antiguos con clave mayor que
+        ``value``, en orden. Coste O(log n + limit).
+        :param value:
+        :param limit:
+        :return:
+        """
+        key = self.key
+
+        def fn(lo, hi):
+            start = self._bisect(lo, hi, value, key, right=True)
+            return self._slice(start, min(start + limit, hi))
+        return self._read(fn)
+
+    def snapshot(self):
+        """
+        Copia coherente de todo el contenido, del más antiguo al más reciente.
+        :return:
+        """
+        return self._read(self._slice)
+
+    def oldest(self):
+        """
+        Devuelve el elemento más antiguo o ``None`` si está vacío.
+        :return:
+        """
+        def fn(lo, hi):
+            return self._slots[lo % self._size] if lo < hi else None
+        return self._read(fn)
+
+    def before(self, value, limit, key=None):
+        """
+        Devuelve los ``limit`` elementos más recientes con clave menor que
+        ``value``, en orden. Coste O(log n + limit).
+        :param value:
+        :param limit:
+        :param key: Clave alternativa (también creciente) para la búsqueda
+        :return:
+        """
+        key = key or self.key
+
+        def fn(lo, hi):
+            stop = self._bisect(lo, hi, value, key)
+            return self._slice(max(stop - limit, lo), stop)
+        return self._read(fn)
+
+    def after(self, value, limit):
+        """
+        Devuelve los ``limit`` elementos más recientes con clave mayor que
+        ``value``, en orden. Coste O(log n + limit).
+        :param value:
+        :param limit:
+        :return:
+        """
+        key = self.key
+
+        def fn(lo, hi):
+            start = self._bisect(lo, hi, value, key, right=True)
+            return self._slice(max(start, hi - limit), hi)
+        return self._read(fn)
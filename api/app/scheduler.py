@@ -0,0 +1,118 @@
+"""
+Planificador de bajada con control de ciclo de trabajo (duty cycle).
+
+Cada mensaje de bajada se encola con el tiempo en el aire de la trama que
+transmitirá el puente. Tras liberar una trama de ``t`` segundos, la
+siguiente no sale hasta pasados ``t / duty_cycle`` segundos (1 % en EU868:
+100 veces el tiempo en el aire), de modo que la radio nunca recibe más de lo
+que puede transmitir legalmente.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """
+    La cola de bajada ha alcanzado su tamaño máximo.
+    """
+
+
+class Job:
+    """
+    Mensaje de bajada pendiente de liberar.
+    """
+    __slots__ = ("message", "airtime", "eta")
+
+    def __init__(self, message, airtime, eta):
+        self.message = message
+        self.airtime = airtime
+        self.eta = eta
+
+
+class DownlinkScheduler:
+    """
+    Cola FIFO de bajada que libera las tramas al ritmo máximo legal.
+    """
+
+    def __init__(self, send, airtime, duty_cycle=0.01, maxsize=1000):
+        """
+        :param send: Corrutina ``send(message)`` que publica el mensaje
+        :param airtime: Función ``airtime(message)`` con el tiempo en el aire en segundos
+        :param duty_cycle: Fracción de tiempo que se puede transmitir (0.01 = 1 %)
+        :param maxsize: Tamaño máximo de la cola
+        """
+        self.send = send
+        self.airtime = airtime
+        self.duty_cycle = duty_cycle
+        self.maxsize = maxsize
+        self._queue = deque()
+        self._wakeup = asyncio.Event()
+        self._next_free = 0.0      # instante (monotónico) en que se puede transmitir
+        self._task = None
+
+    def _period(self, airtime):
+        return airtime / self.duty_cycle
+
+    def start(self):
+        """
+        Arranca la tarea que libera las tramas.
+        :return:
+        """
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Detiene la tarea. Los mensajes aún en cola se descartan.
+        :return:
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._queue:
+            logger.warning(f"Discarding {len(self._queue)} queued downlink messages")
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, message):
+        """
+        Encola un mensaje y devuelve su posición y la hora estimada de envío.
+        :param message:
+        :return: (posición en la cola empezando en 1, ETA como marca de tiempo Unix, tiempo en el aire en s)
+        """
+        if len(self._queue) >= self.maxsize:
+            raise QueueFull()
+        now = time.monotonic()
+        airtime = self.airtime(message)
+        if self._queue:
+            last = self._queue[-1]
+            eta = last.eta + self._period(last.airtime)
+        else:
+            eta = max(now, self._next_free)
+        self._queue.append(Job(message, airtime, eta))
+        self._wakeup.set()
+        return len(self._queue), time.time() + (eta - now), airtime
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._next_free - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            job = self._queue.popleft()
+            self._next_free = time.monotonic() + self._period(job.airtime)
+            try:
+                await self.send(job.message)
+            except Exception as e:
+                logger.error(f"Failed to release downlink message: {e!r}")
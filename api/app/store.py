@@ -0,0 +1,414 @@
+"""
+Histórico persistente de mensajes en SQLite.
+
+La base de datos funciona en modo WAL: un único hilo escritor agrupa las
+inserciones que llegan en una ventana corta y las confirma en una sola
+transacción, mientras los lectores consultan sin bloquearse. Las lecturas se
+hacen por clave (número de secuencia o marca de tiempo) y nunca recorren la
+tabla completa. Cada canal tiene su propio índice (canal, secuencia), así
+que la historia de un canal se pagina igual de rápido que la global.
+
+El texto y el remitente de cada mensaje se indexan además en una tabla FTS5
+(índice invertido) que un trigger mantiene al día en la misma transacción
+que la inserción, así que la búsqueda nunca va por detrás del histórico.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+
+import msgspec
+
+from .messages import Gateway, Message, Record, encode
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    seq     INTEGER PRIMARY KEY,
+    ts      REAL NOT NULL,
+    topic   TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    source  TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    gateways TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+CREATE TABLE IF NOT EXISTS counters (
+    name  TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Índice de texto completo sobre messages (external content: no duplica el
+# texto), con índices de prefijos de 2 y 3 letras para las búsquedas ``palabra*``
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    payload, source, content='messages', content_rowid='seq',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, payload, source) VALUES (new.seq, new.payload, new.source);
+END;
+"""
+
+_SELECT = "SELECT seq, ts, topic, payload, source, channel, gateways FROM messages"
+
+_gateways_decoder = msgspec.json.Decoder(tuple[Gateway, ...])
+
+
+def _row_to_record(row):
+    gateways = row[6]
+    if gateways is not None:
+        gateways = _gateways_decoder.decode(gateways)
+    return Record(Message(*row[:6], gateways))
+
+
+def _record_to_row(record):
+    m = record.msg
+    gateways = encode(m.gateways).decode() if m.gateways else None
+    return m.seq, m.ts, m.topic, m.payload, m.source, m.channel, gateways
+
+
+def match_expression(text):
+    """
+    Convierte el texto buscado en una consulta FTS5: cada palabra es una
+    frase entre comillas (así la sintaxis de FTS5 no se interpreta) y todas
+    deben aparecer. Una palabra terminada en ``*`` busca por prefijo.
+    :param text:
+    :return: Expresión MATCH, o None si no hay ninguna palabra
+    """
+    terms = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*").replace('"', '""')
+        if word:
+            terms.append(f'"{word}"*' if prefix else f'"{word}"')
+    return " ".join(terms) or None
+
+
+def _channel_filter(channels):
+    """
+    Condición SQL (y sus parámetros) para limitar una consulta a unos canales.
+    :param channels: Conjunto de canales, o None para todos
+    :return:
+    """
+    if channels is None:
+        return "", ()
+    return f" AND channel IN ({', '.join('?' * len(channels))})", tuple(channels)
+
+
+class MessageStore:
+    """
+    Almacén SQLite con escritura agrupada en un hilo dedicado.
+    """
+
+    def __init__(self, path, batch_window=0.01, batch_max=500, default_channel="general", settle=2.0):
+        """
+        :param path: Ruta del fichero SQLite
+        :param batch_window: Segundos que el escritor espera para agrupar inserciones
+        :param batch_max: Máximo de mensajes por transacción
+        :param default_channel: Canal de los mensajes guardados antes de que existieran canales
+        :param settle: Segundos tras los que un hueco en la numeración se da por definitivo
+            (ver ``committed_seq``)
+        """
+        self.path = path
+        self.default_channel = default_channel
+        self.batch_window = batch_window
+        self.batch_max = batch_max
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._writer = None
+        self.epoch = 0                 # identificador de la base de datos, fijado en open()
+        self.settle = settle
+        self._committed = 0            # hasta aquí no quedan huecos pendientes (committed_seq)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        # Varios procesos (workers) pueden compartir el fichero
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def _reader(self):
+        """
+        Conexión de lectura propia de cada hilo.
+        :return:
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def open(self):
+        """
+        Crea el esquema si no existe y arranca el hilo escritor.
+        :return:
+        """
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        indexed = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+        if "channel" not in columns:
+            with conn:
+                conn.execute("ALTER TABLE messages ADD COLUMN channel TEXT NOT NULL DEFAULT ''")
+                conn.execute("UPDATE messages SET channel = ?", (self.default_channel,))
+            logger.info(f"Assigned existing messages to channel {self.default_channel}")
+        if "gateways" not in columns:
+            conn.execute("ALTER TABLE messages ADD COLUMN gateways TEXT")
+        conn.execute("CREATE INDEX IF NOT EXISTS messages_channel ON messages (channel, seq)")
+        conn.executescript(SEARCH_SCHEMA)
+        if not indexed:
+            # Histórico anterior al índice de búsqueda: indexarlo una vez
+            with conn:
+                conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            logger.info("Built full-text search index")
+        with conn:
+            # Identifica esta base de datos: cambia si se borra el histórico y la numeración vuelve a empezar
+            conn.execute("INSERT INTO counters (name, value) VALUES ('epoch', ?) ON CONFLICT (name) DO NOTHING",
+                         (int(time.time()),))
+            # El contador compartido nunca queda por detrás del histórico
+            conn.execute(
+                "INSERT INTO counters (name, value) SELECT 'seq', coalesce(max(seq), 0) FROM messages WHERE true "
+                "ON CONFLICT (name) DO UPDATE SET value = max(value, excluded.value)"
+            )
+        self.epoch = conn.execute("SELECT value FROM counters WHERE name = 'epoch'").fetchone()[0]
+        row = conn.execute("SELECT max(seq) FROM messages WHERE ts < ?", (time.time() - self.settle,)).fetchone()
+        self._committed = row[0] or 0
+        conn.close()
+        self._writer = threading.Thread(target=self._write_loop, name="store-writer", daemon=True)
+        self._writer.start()
+        logger.info(f"Message store ready at {self.path}")
+
+    def close(self):
+        """
+        Vacía la cola de escritura y detiene el hilo escritor.
+        :return:
+        """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def append(self, record):
+        """
+        Encola un mensaje para su inserción. No bloquea.
+        :param record:
+        :return:
+        """
+        self._queue.put(record)
+
+    def pending(self):
+        """
+        Número de mensajes que esperan a ser escritos.
+        :return:
+        """
+        return self._queue.qsize()
+
+    def _write_loop(self):
+        conn = self._connect()
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_max:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            try:
+                with conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO messages (seq, ts, topic, payload, source, channel, gateways) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [_record_to_row(r) for r in batch],
+                    )
+            except sqlite3.Error as e:
+                logger.error(f"Failed to persist {len(batch)} messages: {e}")
+        conn.close()
+
+    def allocate_seq(self):
+        """
+        Reserva el siguiente número de secuencia en el contador compartido de
+        la base de datos. Permite que varios procesos numeren los mensajes
+        sin repetir ni saltar números.
+        :return:
+        """
+        return self.allocate("seq")
+
+    def allocate(self, name):
+        """
+        Incrementa el contador compartido ``name`` (que empieza en 1) y
+        devuelve su nuevo valor.
+        :param name:
+        :return:
+        """
+        conn = self._reader()
+        with conn:
+            row = conn.execute(
+                "INSERT INTO counters (name, value) VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET value = value + 1 RETURNING value", (name,)
+            ).fetchone()
+        return row[0]
+
+    def last_seq(self):
+        """
+        Devuelve el mayor número de secuencia guardado (0 si no hay mensajes).
+        :return:
+        """
+        row = self._reader().execute("SELECT max(seq) FROM messages").fetchone()
+        return row[0] or 0
+
+    def committed_seq(self):
+        """
+        Mayor número de secuencia hasta el que están escritos todos los
+        mensajes. Con varios workers cada uno escribe sus mensajes en su
+        propio lote, así que el 11 puede verse en SQLite antes que el 10: lo
+        que queda por encima de este valor puede tener huecos que aún se van
+        a llenar. Un hueco con más de ``settle`` segundos se da por definitivo
+        (el worker que reservó ese número se detuvo antes de escribirlo).
+        :return:
+        """
+        now = time.time()
+        committed = self._committed
+        while True:
+            rows = self._reader().execute(
+                "SELECT seq, ts FROM messages WHERE seq > ? ORDER BY seq LIMIT 1000", (committed,)
+            ).fetchall()
+            for seq, ts in rows:
+                if seq != committed + 1 and now - ts < self.settle:
+                    break
+                committed = seq
+            else:
+                if len(rows) == 1000:
+                    continue
+            break
+        self._committed = max(self._committed, committed)
+        return committed
+
+    def seq_before_ts(self, ts):
+        """
+        Devuelve el número de secuencia del último mensaje anterior a ``ts``.
+        :param ts:
+        :return:
+        """
+        row = self._reader().execute(
+            "SELECT seq FROM messages WHERE ts < ? ORDER BY ts DESC LIMIT 1", (ts,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def page(self, limit, before, channels=None):
+        """
+        Devuelve hasta ``limit`` mensajes con secuencia menor que ``before``,
+        en orden cronológico.
+        :param limit:
+        :param before:
+        :param channels: Canales a incluir, o None para todos
+        :return:
+        """
+        where, params = _channel_filter(channels)
+        rows = self._reader().execute(
+            f"{_SELECT} WHERE seq < ?{where} ORDER BY seq DESC LIMIT ?", (before, *params, limit)
+        ).fetchall()
+        return [_row_to_record(r) for r in reversed(rows)]
+
+    def between(self, after, before, limit, channels=None):
+        """
+        Devuelve los ``limit`` mensajes más recientes con secuencia en el
+        intervalo abierto (``after``, ``before``), en orden cronológico.
+        :param after:
+        :param before:
+        :param limit:
+        :param channels: Canales a incluir, o None para todos
+        :return:
+        """
+        where, params = _channel_filter(channels)
+        rows = self._reader().execute(
+            f"{_SELECT} WHERE seq > ? AND seq < ?{where} ORDER BY seq DESC LIMIT ?",
+            (after, before, *params, limit)
+        ).fetchall()
+        return [_row_to_record(r) for r in reversed(rows)]
+
+    def after(self, after, limit, channels=None):
+        """
+        Devuelve los ``limit`` mensajes más antiguos con secuencia mayor que
+        ``after``, en orden cronológico. Solo incluye mensajes hasta
+        ``committed_seq``: un cliente que avanza su cursor con el último
+        recibido nunca salta uno que aún no estaba escrito.
+        :param after:
+        :param limit:
+        :param channels: Canales a incluir, o None para todos
+        :return:
+        """
+        committed = self.committed_seq()
+        where, params = _channel_filter(channels)
+        rows = self._reader().execute(
+            f"{_SELECT} WHERE seq > ? AND seq <= ?{where} ORDER BY seq LIMIT ?", (after, committed, *params, limit)
+        ).fetchall()
+        return [_row_to_record(r) for r in rows]
+
+    def search(self, match, limit, cursor=None, order="rank", sender=None, since=None, until=None,
+               channels=None):
+        """
+        Busca mensajes en el índice de texto completo. Los resultados se
+        ordenan por relevancia (BM25) o del más reciente al más antiguo, y se
+        paginan por cursor. Con ``order="recent"`` el cursor es la secuencia
+        del último resultado. Con ``order="rank"`` es la última secuencia de
+        la primera página y el número de resultados ya devueltos: BM25 depende
+        de todo el índice y cambia con cada inserción, así que la relevancia
+        no marca una posición; el conjunto hasta esa secuencia no cambia y su
+        orden solo se mueve con la longitud media de los mensajes.
+        :param match: Expresión FTS5 (ver ``match_expression``)
+        :param limit:
+        :param cursor: Posición de la página: (última secuencia incluida,
+            resultados ya devueltos) con ``order="rank"``, secuencia del último
+            resultado con ``order="recent"``
+        :param order: ``rank`` o ``recent``
+        :param sender: Remitente exacto, o None
+        :param since: Marca de tiempo mínima (incluida), o None
+        :param until: Marca de tiempo máxima (excluida), o None
+        :param channels: Canales a incluir, o None para todos
+        :return: Lista de (Record, relevancia)
+        """
+        where, params = _channel_filter(channels)
+        params = [match, *params]
+        if sender is not None:
+            where += " AND m.source = ?"
+            params.append(sender)
+        if since is not None:
+            where += " AND m.ts >= ?"
+            params.append(since)
+        if until is not None:
+            where += " AND m.ts < ?"
+            params.append(until)
+        offset = 0
+        if order == "recent":
+            if cursor is not None:
+                where += " AND f.rowid < ?"
+                params.append(cursor)
+            order_by = "f.rowid DESC"
+        else:
+            if cursor is not None:
+                snapshot, offset = cursor
+                where += " AND f.rowid <= ?"
+                params.append(snapshot)
+            order_by = "f.rank, f.rowid DESC"
+        rows = self._reader().execute(
+            "SELECT m.seq, m.ts, m.topic, m.payload, m.source, m.channel, m.gateways, f.rank "
+            "FROM messages_fts f JOIN messages m ON m.seq = f.rowid "
+            f"WHERE messages_fts MATCH ?{where} ORDER BY {order_by} LIMIT ? OFFSET ?",
+            (*params, limit, offset)
+        ).fetchall()
+        return [(_row_to_record(r), r[7]) for r in rows]
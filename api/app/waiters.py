@@ -0,0 +1,89 @@
+"""
+Espera de mensajes nuevos para el long-polling de ``/messages/wait``.
+
+Las peticiones aparcadas esperan en una ``asyncio.Condition``: no ocupan
+CPU ni cola propia mientras no llega nada. Cada mensaje nuevo actualiza el
+último número de secuencia de su canal y despierta a las esperas, que
+comprueban si hay algo posterior a su cursor en los canales que les
+interesan. Varios mensajes seguidos se despiertan con un único aviso.
+
+Se recuerdan como mucho ``maxsize`` canales: cualquiera puede publicar en
+canales nuevos. Un canal olvidado cuenta como sin mensajes hasta el
+siguiente, que es el que despierta a quien lo espera.
+"""
+import asyncio
+from collections import OrderedDict
+
+
+class MessageWaiters:
+    """
+    Peticiones esperando mensajes posteriores a un número de secuencia. Se
+    usa solo desde el event loop.
+    """
+
+    def __init__(self, maxsize=10000):
+        """
+        :param maxsize: Máximo de canales recordados; al superarlo se olvidan los menos activos
+        """
+        self.maxsize = maxsize
+        self.waiting = 0
+        self._condition = None
+        self._last = OrderedDict()     # canal -> último número de secuencia avisado, del menos al más reciente
+        self._newest = 0
+        self._wake_pending = False
+
+    def __len__(self):
+        return self.waiting
+
+    def newest(self, channels=None):
+        """
+        Último número de secuencia avisado en ``channels``.
+        :param channels: Canales, o None para todos
+        :return:
+        """
+        if channels is None:
+            return self._newest
+        return max((self._last.get(channel, 0) for channel in channels), default=0)
+
+    def notify(self, seq, channel):
+        """
+        Avisa de un mensaje nuevo.
+        :param seq:
+        :param channel:
+        :return:
+        """
+        if seq > self._last.get(channel, 0):
+            self._last[channel] = seq
+        self._last.move_to_end(channel)
+        if len(self._last) > self.maxsize:
+            self._last.popitem(last=False)
+        self._newest = max(self._newest, seq)
+        if self.waiting and not self._wake_pending:
+            self._wake_pending = True
+            asyncio.get_running_loop().create_task(self._wake())
+
+    async def _wake(self):
+        self._wake_pending = False
+        async with self._condition:
+            self._condition.notify_all()
+
+    async def wait(self, after, channels, timeout):
+        """
+        Espera a que se avise de un mensaje posterior a ``after`` en
+        ``channels``.
+        :param after: Número de secuencia que el cliente ya tiene
+        :param channels: Canales, o None para todos
+        :param timeout: Segundos máximos de espera
+        :return: True si llegó un mensaje; False si se agotó el tiempo
+        """
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        self.waiting += 1
+        try:
+            async with self._condition:
+                await asyncio.wait_for(self._condition.wait_for(lambda: self.newest(channels) > after), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
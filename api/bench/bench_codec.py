@@ -0,0 +1,125 @@
+"""
+Micro-benchmark del pipeline de mensajes: ``json`` + FastAPI/pydantic frente a
+msgspec con codificación única.
+
+Mide, por mensaje, el coste de la ingesta (paquete MQTT → mensaje guardado),
+de la difusión a ``--clients`` WebSockets y de servir una página de
+``/messages/`` de ``--page`` mensajes. Compara también la ingesta y el
+tamaño de los paquetes en JSON y en sobre binario (``app.envelope``).
+
+Uso (desde ``api/``)::
+
+    python -m bench.bench_codec --messages 20000 --clients 50
+"""
+import argparse
+import json
+import time
+
+from fastapi.encoders import jsonable_encoder
+
+from app import envelope
+from app.messages import Message, Record, decode_uplink, encode_list
+
+
+def make_payloads(n):
+    return [
+        json.dumps({"from": f"Node-{i % 97:06X}", "message": f"Mensaje de prueba número {i} ñ"}).encode()
+        for i in range(n)
+    ]
+
+
+def make_envelopes(n):
+    return [
+        envelope.pack(f"Node-{i % 97:06X}", f"Mensaje de prueba número {i} ñ")
+        for i in range(n)
+    ]
+
+
+def legacy_ingest(payloads):
+    out = []
+    for seq, raw in enumerate(payloads, 1):
+        payload_str = raw.decode()
+        try:
+            data = json.loads(payload_str)
+            message = data.get("message", payload_str)
+            sender = data.get("from", "desconocido")
+        except Exception:
+            message = payload_str
+            sender = "desconocido"
+        out.append({"seq": seq, "ts": time.time(), "topic": "lorachat/up", "payload": message, "source": sender})
+    return out
+
+
+def legacy_fanout(records, clients):
+    # WebSocket.send_json de Starlette serializa una vez por cliente
+    for r in records:
+        for _ in range(clients):
+            json.dumps(r, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def legacy_page(records, page):
+    # Respuesta por defecto de FastAPI: jsonable_encoder + JSONResponse
+    for i in range(0, len(records), page):
+        content = jsonable_encoder({"count": len(records), "messages": records[i:i + page]})
+        json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+def typed_ingest(payloads):
+    out = []
+    for seq, raw in enumerate(payloads, 1):
+        up = decode_uplink(raw)
+        out.append(Record(Message(seq, time.time(), "lorachat/up", up.message, up.sender, "general")))
+    return out
+
+
+def typed_fanout(records, clients):
+    # Cada cliente reutiliza el texto ya codificado
+    for r in records:
+        for _ in range(clients):
+            r.text.encode()
+
+
+def typed_page(records, page):
+    for i in range(0, len(records), page):
+        b'{"count":%d,"messages":%s}' % (len(records), encode_list(records[i:i + page]))
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - t0, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--page", type=int, default=50)
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.messages)
+    n = args.messages
+
+    rows = []
+    t_old, legacy = timed(legacy_ingest, payloads)
+    t_new, typed = timed(typed_ingest, payloads)
+    rows.append(("ingest", t_old, t_new))
+    rows.append(("fan-out", timed(legacy_fanout, legacy, args.clients)[0], timed(typed_fanout, typed, args.clients)[0]))
+    rows.append(("page", timed(legacy_page, legacy, args.page)[0], timed(typed_page, typed, args.page)[0]))
+
+    print(f"{n} messages, {args.clients} WebSocket clients, pages of {args.page}")
+    print(f"{'stage':<10}{'json+pydantic µs/msg':>22}{'msgspec µs/msg':>18}{'speedup':>10}")
+    for stage, old, new in rows:
+        print(f"{stage:<10}{old / n * 1e6:>22.2f}{new / n * 1e6:>18.2f}{old / new:>9.1f}x")
+
+    envelopes = make_envelopes(n)
+    t_env = timed(typed_ingest, envelopes)[0]
+    size_json = sum(map(len, payloads)) / n
+    size_env = sum(map(len, envelopes)) / n
+    print(f"\n{'payload':<10}{'bytes/msg':>12}{'ingest µs/msg':>16}")
+    print(f"{'json':<10}{size_json:>12.1f}{t_new / n * 1e6:>16.2f}")
+    print(f"{'envelope':<10}{size_env:>12.1f}{t_env / n * 1e6:>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
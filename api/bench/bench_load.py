@@ -0,0 +1,343 @@
+"""
+Prueba de carga de la API con una flota de nodos virtuales.
+
+Arranca un broker local (``bench.minibroker``) y la API con uvicorn, o usa
+los que se indiquen con ``--broker`` y ``--url``. ``--nodes`` puentes
+virtuales publican paquetes con la forma de los del puente
+(``{"from", "message"}``) a un ritmo de Poisson o en ráfagas, mientras
+``--ws`` clientes WebSocket y ``--pollers`` clientes de ``/messages/``
+consumen. Al terminar se escribe un informe JSON con el rendimiento, los
+percentiles de latencia y los mensajes perdidos.
+
+La latencia se mide de la publicación MQTT a la recepción en el WebSocket
+con el reloj de esta máquina: cada mensaje lleva su instante de envío en el
+texto.
+
+Uso (desde ``api/``)::
+
+    python -m bench.bench_load --nodes 20 --rate 5 --ws 100 --duration 30 --output report.json
+    python -m bench.bench_load --pattern burst --burst 50 --workers 2 --broker localhost:1883
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiomqtt
+import httpx
+import websockets
+
+from bench.minibroker import MiniBroker
+
+PREFIX = "bench"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentiles(values):
+    """
+    Resumen de una lista de latencias en segundos, en milisegundos.
+    :param values:
+    :return:
+    """
+    if not values:
+        return {"count": 0, "p50": None, "p95": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def pick(p):
+        rank = max(1, -(-len(values) * p // 100))
+        return round(values[rank - 1] * 1000, 3)
+
+    return {"count": len(values), "p50": pick(50), "p95": pick(95), "p99": pick(99),
+            "max": round(values[-1] * 1000, 3)}
+
+
+class Stats:
+    """
+    Contadores compartidos por todas las tareas de la prueba.
+    """
+
+    def __init__(self):
+        self.published = 0
+        self.publish_errors = 0
+        self.ws_latency = []
+        self.ws_received = []       # mensajes de la prueba recibidos por cada cliente WebSocket
+        self.ws_errors = 0
+        self.rest_latency = []
+        self.rest_errors = 0
+
+
+async def node(index, args, stats, rng, stop):
+    """
+    Puente virtual: publica paquetes del nodo ``index`` hasta que ``stop`` se activa.
+    :param index:
+    :param args:
+    :param stats:
+    :param rng: Generador aleatorio propio del nodo
+    :param stop:
+    :return:
+    """
+    name = f"Node-{index:06X}"
+    if args.channels > 1:
+        topic = f"lorachat/{PREFIX}{index % args.channels}/up"
+    else:
+        topic = "lorachat/up"
+    seq = 0
+    async with aiomqtt.Client(args.broker_host, args.broker_port, identifier=f"{PREFIX}-{index}") as client:
+        while not stop.is_set():
+            if args.pattern == "burst":
+                count, delay = args.burst, args.burst / args.rate
+            else:
+                count, delay = 1, rng.expovariate(args.rate)
+            for _ in range(count):
+                seq += 1
+                now = time.time()
+                ms = int(now * 1000)
+                payload = json.dumps({
+                    "from": name,
+                    "message": f"{PREFIX} {index}:{seq} {now:.6f} " + "x" * args.size,
+                    "trace": {"rx": ms, "pub": ms},
+                })
+                try:
+                    await client.publish(topic, payload, qos=args.qos)
+                    stats.published += 1
+                except aiomqtt.MqttError:
+                    stats.publish_errors += 1
+            try:
+                await asyncio.wait_for(stop.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def ws_consumer(args, stats, ready, stop):
+    """
+    Cliente WebSocket: anota la latencia de cada mensaje de la prueba.
+    :param args:
+    :param stats:
+    :param ready: Se activa al conectar
+    :param stop:
+    :return:
+    """
+    url = args.url.replace("http", "ws", 1) + "/ws"
+    received = 0
+    try:
+        async with websockets.connect(url, max_queue=None) as ws:
+            ready.release()
+            while True:
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), 0.5)
+                except asyncio.TimeoutError:
+                    if stop.is_set():
+                        break
+                    continue
+                now = time.time()
+                text = json.loads(raw)["payload"]
+                if not text.startswith(PREFIX + " "):
+                    continue
+                received += 1
+                stats.ws_latency.append(now - float(text.split(" ", 3)[2]))
+    except (OSError, websockets.WebSocketException):
+        stats.ws_errors += 1
+        ready.release()
+    stats.ws_received.append(received)
+
+
+async def poller(args, stats, stop):
+    """
+    Cliente REST que pide la última página de ``/messages/`` cada ``--poll-interval`` s.
+    :param args:
+    :param stats:
+    :param stop:
+    :return:
+    """
+    async with httpx.AsyncClient(base_url=args.url, timeout=10) as client:
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                r = await client.get("/messages/", params={"limit": args.page})
+                r.raise_for_status()
+                stats.rest_latency.append(time.perf_counter() - t0)
+            except httpx.HTTPError:
+                stats.rest_errors += 1
+            try:
+                await asyncio.wait_for(stop.wait(), args.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+
+async def wait_ready(url, timeout=30):
+    async with httpx.AsyncClient(base_url=url) as client:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get("/readyz")).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"API at {url} did not become ready")
+
+
+def start_api(args, workdir):
+    """
+    Arranca la API con uvicorn en un proceso aparte.
+    :param args:
+    :param workdir: Directorio temporal para el histórico y el log
+    :return: (proceso, fichero de log)
+    """
+    port = free_port()
+    args.url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ,
+               MQTT_BROKER=args.broker_host, MQTT_PORT=str(args.broker_port),
+               HISTORY_DB=os.path.join(workdir, "bench.db"), LORA_DUTY_CYCLE="0",
+               API_WORKERS=str(args.workers))
+    for item in args.env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    log = open(os.path.join(workdir, "api.log"), "w")
+    cmd = [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port),
+           "--workers", str(args.workers), "--log-level", "warning"]
+    api_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return subprocess.Popen(cmd, cwd=api_dir, env=env, stdout=log, stderr=subprocess.STDOUT), log
+
+
+async def scrape(args):
+    """
+    Lee ``/latency`` y los contadores de pérdidas de ``/metrics`` de la API.
+    :param args:
+    :return:
+    """
+    out = {}
+    async with httpx.AsyncClient(base_url=args.url, timeout=10) as client:
+        try:
+            out["latency"] = (await client.get("/latency")).json()
+            for line in (await client.get("/metrics")).text.splitlines():
+                if line.startswith(("lorachat_client_dropped_messages_total", "lorachat_client_disconnects_slow_total",
+                                    "lorachat_ingest_messages_total")):
+                    name, value = line.rsplit(" ", 1)
+                    out[name] = float(value)
+        except (httpx.HTTPError, ValueError):
+            pass
+    return out
+
+
+async def run(args):
+    broker = None
+    api = log = None
+    workdir = tempfile.mkdtemp(prefix="lorachat-bench-")
+    if args.broker:
+        args.broker_host, _, port = args.broker.partition(":")
+        args.broker_port = int(port or 1883)
+    else:
+        broker = MiniBroker()
+        args.broker_host = "127.0.0.1"
+        args.broker_port = await broker.start(port=0)
+    try:
+        if not args.url:
+            api, log = start_api(args, workdir)
+        await wait_ready(args.url)
+
+        stats = Stats()
+        stop = asyncio.Event()
+        ready = asyncio.Semaphore(0)
+        consumers = [asyncio.create_task(ws_consumer(args, stats, ready, stop)) for _ in range(args.ws)]
+        for _ in range(args.ws):
+            await ready.acquire()
+        pollers = [asyncio.create_task(poller(args, stats, stop)) for _ in range(args.pollers)]
+
+        rng = random.Random(args.seed)
+        nodes = [asyncio.create_task(node(i, args, stats, random.Random(rng.random()), stop))
+                 for i in range(args.nodes)]
+        t0 = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        stop.set()
+        await asyncio.gather(*nodes)
+        elapsed = time.perf_counter() - t0
+        # Dar tiempo a que lleguen los últimos mensajes
+        await asyncio.sleep(args.drain)
+        await asyncio.gather(*consumers, *pollers)
+        server = await scrape(args)
+    finally:
+        if api is not None:
+            api.terminate()
+            api.wait()
+            log.close()
+        if broker is not None:
+            await broker.stop()
+
+    received = stats.ws_received
+    lost = [stats.published - r for r in received]
+    return {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        "duration_s": round(elapsed, 3),
+        "published": stats.published,
+        "publish_errors": stats.publish_errors,
+        "publish_rate": round(stats.published / elapsed, 1),
+        "ws": {
+            "clients": args.ws,
+            "errors": stats.ws_errors,
+            "delivered": sum(received),
+            "delivery_rate": round(sum(received) / elapsed, 1),
+            "lost_total": sum(lost),
+            "lost_max": max(lost, default=0),
+            "latency_ms": percentiles(stats.ws_latency),
+        },
+        "rest": {
+            "clients": args.pollers,
+            "errors": stats.rest_errors,
+            "latency_ms": percentiles(stats.rest_latency),
+        },
+        "server": server,
+        "workdir": workdir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--nodes", type=int, default=10, help="puentes virtuales")
+    parser.add_argument("--rate", type=float, default=2.0, help="mensajes/s de cada nodo")
+    parser.add_argument("--pattern", choices=("poisson", "burst"), default="poisson")
+    parser.add_argument("--burst", type=int, default=20, help="mensajes por ráfaga (--pattern burst)")
+    parser.add_argument("--size", type=int, default=20, help="bytes de relleno por mensaje")
+    parser.add_argument("--channels", type=int, default=1, help="repartir los nodos entre N canales")
+    parser.add_argument("--qos", type=int, choices=(0, 1), default=1)
+    parser.add_argument("--ws", type=int, default=20, help="clientes WebSocket")
+    parser.add_argument("--pollers", type=int, default=2, help="clientes de /messages/")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--page", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="segundos de carga")
+    parser.add_argument("--drain", type=float, default=2.0, help="segundos de espera al final")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--broker", help="host:puerto de un broker existente (por defecto, uno local)")
+    parser.add_argument("--url", help="URL de una API ya arrancada (por defecto, se arranca una)")
+    parser.add_argument("--workers", type=int, default=1, help="workers de uvicorn")
+    parser.add_argument("--env", action="append", default=[], metavar="CLAVE=VALOR",
+                        help="variable de entorno para la API")
+    parser.add_argument("--output", help="fichero del informe JSON (por defecto, la salida estándar)")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    ws = report["ws"]
+    print(f"{report['published']} published ({report['publish_rate']}/s), "
+          f"{ws['delivered']} delivered to {ws['clients']} clients, {ws['lost_total']} lost, "
+          f"p99 {ws['latency_ms']['p99']} ms", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Broker MQTT 3.1.1 mínimo en asyncio, para los benchmarks.
+
+Sustituye a Mosquitto cuando no está disponible: QoS 0 y 1, comodines
+``+``/``#`` y suscripciones compartidas ``$share/<grupo>/<filtro>``. No
+guarda sesiones ni mensajes retenidos.
+
+Uso (desde ``api/``)::
+
+    python -m bench.minibroker 1883
+"""
+import asyncio
+import itertools
+import struct
+
+
+def _topic_matches(pattern, topic):
+    p, t = pattern.split("/"), topic.split("/")
+    for i, part in enumerate(p):
+        if part == "#":
+            return True
+        if i >= len(t):
+            return False
+        if part != "+" and part != t[i]:
+            return False
+    return len(p) == len(t)
+
+
+def _encode_length(n):
+    out = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        out.append(b | 0x80 if n else b)
+        if not n:
+            return bytes(out)
+
+
+def _utf8(s):
+    b = s.encode()
+    return struct.pack("!H", len(b)) + b
+
+
+class Session:
+    def __init__(self, broker, reader, writer):
+        self.broker = broker
+        self.reader = reader
+        self.writer = writer
+        self.subs = {}
+        self.mid = itertools.cycle(range(1, 65536))
+
+    def send(self, packet_type, body):
+        self.writer.write(bytes([packet_type]) + _encode_length(len(body)) + body)
+
+    def deliver(self, topic, payload, qos):
+        if qos:
+            body = _utf8(topic) + struct.pack("!H", next(self.mid)) + payload
+            self.send(0x32, body)
+        else:
+            self.send(0x30, _utf8(topic) + payload)
+
+    async def read_packet(self):
+        header = await self.reader.readexactly(1)
+        mult, length = 1, 0
+        while True:
+            b = (await self.reader.readexactly(1))[0]
+            length += (b & 0x7F) * mult
+            if not b & 0x80:
+                break
+            mult *= 128
+        body = await self.reader.readexactly(length) if length else b""
+        return header[0], body
+
+    async def run(self):
+        try:
+            while True:
+                first, body = await self.read_packet()
+                kind = first >> 4
+                if kind == 1:      # CONNECT
+                    self.send(0x20, b"\x00\x00")
+                elif kind == 3:    # PUBLISH
+                    qos = (first >> 1) & 3
+                    n = struct.unpack("!H", body[:2])[0]
+                    topic = body[2:2 + n].decode()
+                    pos = 2 + n
+                    if qos:
+                        mid = body[pos:pos + 2]
+                        pos += 2
+                        self.send(0x40, mid)
+                    self.broker.route(topic, body[pos:])
+                elif kind == 4:    # PUBACK de una entrega
+                    pass
+                elif kind == 8:    # SUBSCRIBE
+                    mid, pos, granted = body[:2], 2, bytearray()
+                    while pos < len(body):
+                        n = struct.unpack("!H", body[pos:pos + 2])[0]
+                        topic = body[pos + 2:pos + 2 + n].decode()
+                        qos = body[pos + 2 + n] & 3
+                        pos += 3 + n
+                        self.broker.subscribe(self, topic, min(qos, 1))
+                        granted.append(min(qos, 1))
+                    self.send(0x90, mid + bytes(granted))
+                elif kind == 10:   # UNSUBSCRIBE
+                    self.send(0xB0, body[:2])
+                elif kind == 12:   # PINGREQ
+                    self.send(0xD0, b"")
+                elif kind == 14:   # DISCONNECT
+                    break
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.broker.drop(self)
+            self.writer.close()
+
+
+class MiniBroker:
+    """
+    Broker MQTT en memoria: QoS 0/1, comodines ``+``/``#`` y suscripciones
+    compartidas ``$share/<grupo>/<filtro>`` repartidas por turnos.
+    """
+
+    def __init__(self):
+        self.sessions = set()
+        self.subs = []            # (filtro, sesión, qos)
+        self.shared = {}          # (grupo, filtro) -> [(sesión, qos)]
+        self._rr = {}
+        self._tasks = set()
+        self.server = None
+
+    def subscribe(self, session, topic, qos):
+        if topic.startswith("$share/"):
+            _, group, flt = topic.split("/", 2)
+            self.shared.setdefault((group, flt), []).append((session, qos))
+        else:
+            self.subs.append((topic, session, qos))
+
+    def drop(self, session):
+        self.sessions.discard(session)
+        self.subs = [s for s in self.subs if s[1] is not session]
+        for key, members in self.shared.items():
+            self.shared[key] = [m for m in members if m[0] is not session]
+
+    def route(self, topic, payload):
+        for flt, session, qos in self.subs:
+            if _topic_matches(flt, topic):
+                session.deliver(topic, payload, qos)
+        for (group, flt), members in self.shared.items():
+            if members and _topic_matches(flt, topic):
+                i = self._rr.get((group, flt), 0) % len(members)
+                self._rr[(group, flt)] = i + 1
+                session, qos = members[i]
+                session.deliver(topic, payload, qos)
+
+    async def _handle(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.add(session)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await session.run()
+        finally:
+            self._tasks.discard(task)
+
+    async def start(self, host="127.0.0.1", port=1883):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for s in list(self.sessions):
+            s.writer.close()
+        # Las sesiones terminan al ver cerrado su socket
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+
+if __name__ == "__main__":
+    import sys
+
+    async def main():
+        b = MiniBroker()
+        port = await b.start(port=int(sys.argv[1]) if len(sys.argv) > 1 else 1883)
+        print("listening", port, flush=True)
+        await asyncio.Event().wait()
+
+    asyncio.run(main())
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 import os
 import requests
 
@@ -13,15 +13,37 @@ def index():
 @app.route("/messages")
 def messages():
     limit = request.args.get("limit", 50)
-    resp = requests.get(f"{API_URL}/messages/", params={"limit": limit})
-    return jsonify(resp.json())
+    params = {"limit": limit}
+    if "channels" in request.args:
+        params["channels"] = request.args["channels"]
+    # Petición condicional: si no hay mensajes nuevos la API responde 304 sin cuerpo
+    headers = {}
+    if "If-None-Match" in request.headers:
+        headers["If-None-Match"] = request.headers["If-None-Match"]
+    resp = requests.get(f"{API_URL}/messages/", params=params, headers=headers)
+    out = Response(resp.content, status=resp.status_code, content_type=resp.headers.get("Content-Type"))
+    for name in ("ETag", "Cache-Control"):
+        if name in resp.headers:
+            out.headers[name] = resp.headers[name]
+    return out
 
 @app.route("/publish", methods=["POST"])
 def publish():
     data = request.get_json()
     msg = data.get("message", "")
-    resp = requests.post(f"{API_URL}/publish/", json={"message": msg})
-    return jsonify(resp.json())
+    body = {"message": msg}
+    if data.get("channel"):
+        body["channel"] = data["channel"]
+    # La API limita por cliente: se le pasa la IP del navegador y su API key
+    headers = {"X-Forwarded-For": request.remote_addr}
+    if "X-API-Key" in request.headers:
+        headers["X-API-Key"] = request.headers["X-API-Key"]
+    resp = requests.post(f"{API_URL}/publish/", json=body, headers=headers)
+    out = jsonify(resp.json())
+    out.status_code = resp.status_code
+    if "Retry-After" in resp.headers:
+        out.headers["Retry-After"] = resp.headers["Retry-After"]
+    return out
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000)
\ No newline at end of file
@@ -35,7 +35,15 @@ unreadBadgeContainer.appendChild(unreadBadge)
 headerActions.appendChild(unreadBadgeContainer)
 
 /* ---------- estado ---------- */
-let lastMessage = { source: "", payload: "" }
+let lastSeq = 0 // todos los mensajes hasta este número de secuencia ya se han mostrado
+const seenSeqs = new Set() // mostrados por encima de lastSeq (con varios workers llegan desordenados)
+const SEEN_MAX = 500 // un hueco que sigue abierto tras tantos mensajes ya no se llenará
+const pendingEcho = [] // burbujas de mensajes propios a la espera de su eco (texto en dataset.echo)
+const dlBubbles = new Map() // id de bajada -> burbuja del mensaje enviado
+const dlEarly = new Map() // estados llegados antes que la respuesta de /publish
+const DL_TRACK_MAX = 200
+// Marca de cada estado de entrega (ver api/app/downlinks.py)
+const DL_MARKS = { queued: "🕓", brokered: "✓", transmitted: "✓✓", acked: "✓✓", failed: "!" }
 let unread = 0
 let isNearBottom = true
 let isDarkTheme = true // Tema oscuro por defecto
@@ -116,6 +124,7 @@ function addBubble({ payload, source, time }) {
     // Mostrar botón de scroll y actualizar contador
     scrollDownBtn.classList.remove("hidden")
   }
+  return wrap
 }
 
 // Función para hacer scroll al último mensaje
@@ -152,67 +161,139 @@ function updateUnreadBadge() {
     scrollDownBtn.removeAttribute("data-count")
   }
 }
-/* ---------- carga inicial (últimos PAGE) ---------- */
-;(async () => {
-  const res = await fetch(`/messages?limit=${PAGE}`)
-  const { messages } = await res.json()
-
-  // Para la carga inicial, filtramos mensajes duplicados consecutivos
-  let prevMsg = { source: "", payload: "" }
-
-  messages.forEach((m) => {
-    // Solo añadir si es diferente al mensaje anterior
-    if (m.source !== prevMsg.source || m.payload !== prevMsg.payload) {
-      addBubble({
-        payload: m.payload,
-        source: m.source,
-        time: new Date().toLocaleTimeString().slice(0, 5),
-      })
-
-      // Actualizar el mensaje anterior
-      prevMsg = { source: m.source, payload: m.payload }
-    }
+/* ---------- recepción ---------- */
+function formatTime(ts) {
+  return (ts ? new Date(ts * 1000) : new Date()).toLocaleTimeString().slice(0, 5)
+}
+
+// Anota un número de secuencia; false si ya se había mostrado
+function markSeen(seq) {
+  if (seq <= lastSeq || seenSeqs.has(seq)) return false
+  seenSeqs.add(seq)
+  if (seenSeqs.size > SEEN_MAX) lastSeq = Math.min(...seenSeqs) - 1
+  while (seenSeqs.delete(lastSeq + 1)) lastSeq++
+  return true
+}
+
+// Pinta un mensaje del servidor salvo que ya se haya mostrado
+function handleMessage(m) {
+  if (!markSeen(m.seq)) return
+
+  // Eco de un mensaje propio que ya se pintó al enviarlo
+  if (m.source === LOCAL_SOURCE && pendingEcho.length && pendingEcho[0].dataset.echo === m.payload) {
+    delete pendingEcho.shift().dataset.echo
+    return
+  }
+
+  addBubble({
+    payload: m.payload,
+    source: m.source || "?",
+    time: formatTime(m.ts),
   })
 
-  // Guardar el último mensaje para comparar con nuevos WebSocket
-  if (messages.length > 0) {
-    const lastMsg = messages[messages.length - 1]
-    lastMessage = { source: lastMsg.source, payload: lastMsg.payload }
+  // Si no estamos cerca del final, incrementar contador de no leídos
+  if (!isNearBottom && m.source !== LOCAL_SOURCE) {
+    unread++
+    updateUnreadBadge()
   }
+}
 
-  scrollToBottom() // Asegurar scroll al fondo
-  inputEl.focus()
-})()
+// Deja de esperar el eco de un mensaje enviado que no se va a publicar
+function dropEcho(bubble) {
+  const i = pendingEcho.indexOf(bubble)
+  if (i >= 0) pendingEcho.splice(i, 1)
+  delete bubble.dataset.echo
+}
 
-/* ---------- WebSocket ---------- */
-const wsUrl = (location.protocol === "https:" ? "wss://" : "ws://") + location.hostname + ":8000/ws"
-const ws = new WebSocket(wsUrl)
+// Muestra el estado de entrega de un mensaje enviado
+function setStatus(bubble, state) {
+  if (state === "failed") dropEcho(bubble)
+  let mark = bubble.querySelector(".status")
+  if (!mark) {
+    mark = document.createElement("span")
+    mark.className = "status"
+    bubble.querySelector(".time").appendChild(mark)
+  }
+  mark.textContent = DL_MARKS[state] || ""
+  mark.dataset.state = state
+  mark.title = state
+}
+
+// Evento de estado de un mensaje de bajada
+function handleDownlink(d) {
+  const bubble = dlBubbles.get(d.id)
+  if (bubble) {
+    setStatus(bubble, d.state)
+    return
+  }
+  // Puede llegar antes que la respuesta de /publish con su id
+  dlEarly.set(d.id, d.state)
+  if (dlEarly.size > DL_TRACK_MAX) dlEarly.delete(dlEarly.keys().next().value)
+}
 
-ws.onopen = () => headerEl.classList.add("online")
-ws.onclose = () => headerEl.classList.remove("online")
+// Asocia la burbuja de un mensaje enviado con su id de bajada
+function trackDownlink(id, bubble) {
+  dlBubbles.set(id, bubble)
+  if (dlBubbles.size > DL_TRACK_MAX) dlBubbles.delete(dlBubbles.keys().next().value)
+  setStatus(bubble, dlEarly.get(id) || "queued")
+  dlEarly.delete(id)
+}
 
-ws.onmessage = (e) => {
-  const { payload, source = "?" } = JSON.parse(e.data)
+function handleFrame(item) {
+  if (item.type === "downlink") {
+    handleDownlink(item)
+  } else {
+    handleMessage(item)
+  }
+}
 
-  // Solo añadir burbuja si el mensaje es diferente al último
-  if (source !== lastMessage.source || payload !== lastMessage.payload) {
-    addBubble({
-      payload,
-      source,
-      time: new Date().toLocaleTimeString().slice(0, 5),
-    })
+/* ---------- WebSocket ---------- */
+const wsBase = (location.protocol === "https:" ? "wss://" : "ws://") + location.hostname + ":8000/ws"
+let retryDelay = 1000
+let loaded = false // ya se pintó el histórico inicial
+
+// La primera vez pide los últimos PAGE mensajes en el propio WebSocket (el
+// primer frame); al reconectar, solo lo que falta desde el último mostrado
+function connect() {
+  const query = loaded ? `since=${lastSeq}` : `history=${PAGE}`
+  // Se prefiere MessagePack (frames binarios); el servidor puede elegir JSON
+  const ws = new WebSocket(`${wsBase}?${query}`, ["lorachat.msgpack", "lorachat.json"])
+  ws.binaryType = "arraybuffer"
+
+  ws.onopen = () => {
+    headerEl.classList.add("online")
+    retryDelay = 1000
+  }
 
-    // Actualizar el último mensaje
-    lastMessage = { source, payload }
+  ws.onclose = () => {
+    headerEl.classList.remove("online")
+    setTimeout(connect, retryDelay)
+    retryDelay = Math.min(retryDelay * 2, 30000)
+  }
 
-    // Si no estamos cerca del final, incrementar contador de no leídos
-    if (!isNearBottom && source !== LOCAL_SOURCE) {
-      unread++
-      updateUnreadBadge()
+  ws.onmessage = (e) => {
+    const data = typeof e.data === "string" ? JSON.parse(e.data) : msgpackDecode(e.data)
+    if (!loaded && Array.isArray(data) && data.length) {
+      // El histórico inicial son los últimos mensajes, no todos desde el 1
+      lastSeq = data[0].seq - 1
+    }
+    // El hueco desde la última conexión, o varios mensajes seguidos, llegan en un único frame (lista)
+    if (Array.isArray(data)) {
+      data.forEach(handleFrame)
+    } else {
+      handleFrame(data)
+    }
+    if (!loaded) {
+      loaded = true
+      scrollToBottom() // Asegurar scroll al fondo tras el histórico inicial
     }
   }
 }
 
+/* ---------- arranque ---------- */
+inputEl.focus()
+connect()
+
 /* ---------- enviar ---------- */
 formEl.addEventListener("submit", async (e) => {
   e.preventDefault()
@@ -221,24 +302,34 @@ formEl.addEventListener("submit", async (e) => {
 
   // Mostrar inmediatamente el mensaje enviado en el chat
   const time = new Date().toLocaleTimeString().slice(0, 5)
-  addBubble({
+  const bubble = addBubble({
     payload: txt,
     source: LOCAL_SOURCE,
     time: time,
   })
 
-  // Actualizar el último mensaje para evitar duplicados
-  lastMessage = { source: LOCAL_SOURCE, payload: txt }
+  // Recordar el mensaje para no pintarlo de nuevo cuando llegue su eco
+  bubble.dataset.echo = txt
+  pendingEcho.push(bubble)
 
   // Enviar al servidor
   try {
-    await fetch("/publish", {
+    const res = await fetch("/publish", {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify({ message: txt }),
     })
+    const { id, detail } = await res.json()
+    if (id !== undefined) {
+      trackDownlink(id, bubble)
+    } else if (!res.ok) {
+      // Rechazado (p. ej. 429 por el límite de tiempo en el aire)
+      setStatus(bubble, "failed")
+      bubble.querySelector(".status").title = detail || res.statusText
+    }
   } catch (error) {
     console.error("Error al enviar mensaje:", error)
+    setStatus(bubble, "failed")
   }
 
   inputEl.value = ""
@@ -0,0 +1,64 @@
+/* Decodificador MessagePack mínimo para los frames del subprotocolo lorachat.msgpack.
+   Cubre los tipos que envía la API: nil, bool, enteros, float, str, array y map. */
+
+const utf8 = new TextDecoder()
+
+function msgpackDecode(buffer) {
+  const view = new DataView(buffer)
+  const bytes = new Uint8Array(buffer)
+  let pos = 0
+
+  const str = (len) => {
+    const s = utf8.decode(bytes.subarray(pos, pos + len))
+    pos += len
+    return s
+  }
+  const array = (len) => {
+    const out = new Array(len)
+    for (let i = 0; i < len; i++) out[i] = read()
+    return out
+  }
+  const map = (len) => {
+    const out = {}
+    for (let i = 0; i < len; i++) {
+      const key = read()
+      out[key] = read()
+    }
+    return out
+  }
+
+  function read() {
+    const b = bytes[pos++]
+    if (b <= 0x7f) return b
+    if (b >= 0xe0) return b - 0x100
+    if ((b & 0xf0) === 0x80) return map(b & 0x0f)
+    if ((b & 0xf0) === 0x90) return array(b & 0x0f)
+    if ((b & 0xe0) === 0xa0) return str(b & 0x1f)
+    let v
+    switch (b) {
+      case 0xc0: return null
+      case 0xc2: return false
+      case 0xc3: return true
+      case 0xca: v = view.getFloat32(pos); pos += 4; return v
+      case 0xcb: v = view.getFloat64(pos); pos += 8; return v
+      case 0xcc: return bytes[pos++]
+      case 0xcd: v = view.getUint16(pos); pos += 2; return v
+      case 0xce: v = view.getUint32(pos); pos += 4; return v
+      case 0xcf: v = Number(view.getBigUint64(pos)); pos += 8; return v
+      case 0xd0: return view.getInt8(pos++)
+      case 0xd1: v = view.getInt16(pos); pos += 2; return v
+      case 0xd2: v = view.getInt32(pos); pos += 4; return v
+      case 0xd3: v = Number(view.getBigInt64(pos)); pos += 8; return v
+      case 0xd9: return str(bytes[pos++])
+      case 0xda: v = view.getUint16(pos); pos += 2; return str(v)
+      case 0xdb: v = view.getUint32(pos); pos += 4; return str(v)
+      case 0xdc: v = view.getUint16(pos); pos += 2; return array(v)
+      case 0xdd: v = view.getUint32(pos); pos += 4; return array(v)
+      case 0xde: v = view.getUint16(pos); pos += 2; return map(v)
+      case 0xdf: v = view.getUint32(pos); pos += 4; return map(v)
+    }
+    throw new Error(`msgpack: tipo 0x${b.toString(16)} no soportado`)
+  }
+
+  return read()
+}
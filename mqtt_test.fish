@@ -4,7 +4,7 @@
 # ─── Configura aquí tus parámetros MQTT ────────────────────────────────
 set broker  192.168.1.40
 set port    1883
-set topic   test/topic
+set topic   lorachat/up
 set interval 10        # segundos entre mensajes
 
 # ─── Generador sencillo de palabras aleatorias ─────────────────────────
@@ -27,7 +27,7 @@ end
 while true
     set msg (random_word)
     echo "⮕  Publicando \"$msg\""
-    mosquitto_pub -h $broker -p $port -t $topic -m $msg
+    mosquitto_pub -h $broker -p $port -t $topic -m "{\"from\": \"Node-F15H00\", \"message\": \"$msg\"}"
     sleep $interval
 end
 
@@ -8,9 +8,10 @@ transparente entre nodos LoRa y una infraestructura MQTT.
 Versión optimizada con protector de pantalla OLED y activación por botón.
 """
 # ───────── Imports ─────────────────────────────────────────────────────────
-import time, gc, ubinascii, ujson
+import time, gc, struct, ubinascii, ujson
 from machine import Pin, I2C, WDT
 import network
+import ntptime
 from umqtt.robust import MQTTClient
 from sx1262 import SX1262
 import ssd1306
@@ -68,6 +69,8 @@ MQTT_USER     = getenv(ENV, "MQTT_USER", str, None)
 MQTT_PASS     = getenv(ENV, "MQTT_PASSWORD", str, None)
 MQTT_TOPIC_UP   = getenv(ENV, "MQTT_TOPIC_UP",   str, "lorachat/up").encode()
 MQTT_TOPIC_DOWN = getenv(ENV, "MQTT_TOPIC_DOWN", str, "lorachat/down").encode()
+# Estado de cada mensaje de bajada tras transmitirlo por LoRa (ver api/app/downlinks.py)
+MQTT_TOPIC_STATUS = getenv(ENV, "MQTT_TOPIC_STATUS", str, "lorachat/status").encode()
 MQTT_QOS      = getenv(ENV, "MQTT_QOS", int, 1)
 MQTT_RETAIN_UP= bool(getenv(ENV, "MQTT_RETAIN_UP", int, 0))
 MQTT_RECON_MAX= getenv(ENV, "MQTT_RECONNECT_MAX", int, 30000)  # ms
@@ -81,6 +84,15 @@ TX_POWER   = getenv(ENV, "TRANSMIT_POWER", int, 14)
 
 BRIGHTNESS = getenv(ENV, "BRIGHTNESS", int, 200)
 
+# Marcas de tiempo de latencia (recepción LoRa y publicación MQTT) en cada uplink
+LATENCY_TRACE = bool(getenv(ENV, "LATENCY_TRACE", int, 1))
+NTP_HOST      = getenv(ENV, "NTP_HOST", str, "pool.ntp.org")
+NTP_INTERVAL  = getenv(ENV, "NTP_INTERVAL", int, 3600) * 1000  # ms entre sincronizaciones
+# Identificador del puente y señal (RSSI/SNR) en cada uplink, para combinar copias de varios puentes
+GATEWAY_META  = bool(getenv(ENV, "GATEWAY_META", int, 1))
+# Uplinks en sobre binario (ver api/app/envelope.py) en lugar de JSON
+MQTT_BINARY   = bool(getenv(ENV, "MQTT_BINARY", int, 0))
+
 # Tiempo de inactividad antes de apagar la pantalla (5 minutos en ms)
 SCREEN_TIMEOUT = 5 * 60 * 1000
 
@@ -93,6 +105,7 @@ button = None
 oled = None
 mqttc = None
 lora = None
+tx_pending = None   # id del mensaje de bajada en transmisión
 
 # ───────── 5. OLED helpers ───────────────────────────────────────────────
 def activate_screen():
@@ -237,10 +250,100 @@ def init_lora():
     if err: raise RuntimeError("LoRa init err %d" % err)
     return lora
 
+# ───────── 6b. Reloj (SNTP) ──────────────────────────────────────────────
+# Algunos puertos de MicroPython cuentan desde el 1-1-2000 en lugar de 1970
+EPOCH_OFFSET_MS = (946684800 if time.gmtime(0)[0] == 2000 else 0) * 1000
+
+def sync_clock():
+    """
+    Sincroniza el reloj con SNTP para que las marcas de tiempo sean
+    comparables con las de la API.
+    :return:
+    """
+    try:
+        ntptime.host = NTP_HOST
+        ntptime.settime()
+        oled_log("NTP OK")
+    except Exception as e:
+        oled_log(f"NTP err: {str(e)[:10]}")
+
+def now_ms():
+    """
+    Milisegundos desde el 1-1-1970 (UTC).
+    :return:
+    """
+    return time.time_ns() // 1_000_000 + EPOCH_OFFSET_MS
+
 # ───────── 7. Node name ─────────────────────────────────────────────────
 mac = network.WLAN(network.STA_IF).config('mac')
 NODE_NAME = "Node-" + ubinascii.hexlify(mac).decode()[-6:].upper()
 
+# ───────── 7b. Sobre binario (mismo formato que api/app/envelope.py) ────
+ENV_MAGIC, ENV_VERSION = 0xB1, 1
+ENV_SEQ, ENV_TS, ENV_PUB, ENV_GW = 0x01, 0x02, 0x04, 0x08
+
+def pack_envelope(js, pub):
+    """
+    Codifica un uplink (JSON decodificado y anotado) en sobre binario.
+    :param js: dict con from, message y, si los hay, id, trace y gw
+    :param pub: Instante de publicación (ms desde 1970) o None
+    :return: bytes
+    """
+    sender = str(js.get("from", "")).encode()
+    body = str(js.get("message", "")).encode()
+    flags = 0
+    parts = [b"", sender]
+    if isinstance(js.get("id"), int):
+        flags |= ENV_SEQ
+        parts.append(struct.pack(">I", js["id"] & 0xFFFFFFFF))
+    rx = js.get("trace", {}).get("rx")
+    if rx is not None:
+        flags |= ENV_TS
+        parts.append(struct.pack(">Q", rx))
+    if pub is not None:
+        flags |= ENV_PUB
+        parts.append(struct.pack(">Q", pub))
+    gw = js.get("gw")
+    if gw:
+        flags |= ENV_GW
+        gid = gw["id"].encode()
+        parts.append(bytes((len(gid),)) + gid + struct.pack(">hh", round(gw["rssi"] * 10), round(gw["snr"] * 10)))
+    parts.append(struct.pack(">H", len(body)) + body)
+    parts[0] = bytes((ENV_MAGIC, ENV_VERSION, flags, len(sender)))
+    return b"".join(parts)
+
+def envelope_downlink(msg):
+    """
+    Texto e identificador de un mensaje de bajada en sobre binario, o None
+    si no lo es.
+    :param msg: bytes del paquete MQTT
+    :return: (texto, id o None)
+    """
+    if len(msg) < 6 or msg[0] != ENV_MAGIC or msg[1] != ENV_VERSION:
+        return None
+    flags, pos = msg[2], 4 + msg[3]
+    dl = None
+    if flags & ENV_SEQ:
+        dl = struct.unpack(">I", msg[pos:pos + 4])[0]
+        pos += 4
+    pos += (8 if flags & ENV_TS else 0) + (8 if flags & ENV_PUB else 0)
+    if flags & ENV_GW:
+        pos += 1 + msg[pos] + 4
+    n = struct.unpack(">H", msg[pos:pos + 2])[0]
+    return msg[pos + 2:pos + 2 + n].decode(), dl
+
+def report_status(dl, state):
+    """
+    Informa a la API del resultado de la transmisión de un mensaje de bajada.
+    :param dl: id del mensaje
+    :param state: "transmitted" o "failed"
+    :return:
+    """
+    try:
+        mqttc.publish(MQTT_TOPIC_STATUS, ujson.dumps({"dl": dl, "state": state, "gw": NODE_NAME}), False, 0)
+    except Exception as e:
+        oled_log(f"Status err: {str(e)[:10]}")
+
 # ───────── 8. MQTT → LoRa callback ──────────────────────────────────────
 def make_downlink_cb(lora):
     """
@@ -255,21 +358,36 @@ def make_downlink_cb(lora):
         :param msg:
         :return:
         """
+        global tx_pending
+        dl = None
         try:
-            js = ujson.loads(msg)
-            txt = js.get("message", "")
+            down = envelope_downlink(msg)
+            if down is None:
+                js = ujson.loads(msg)
+                txt, dl = js.get("message", ""), js.get("id")
+            else:
+                txt, dl = down
         except:
             txt = msg.decode()
 
         if not txt:
             return
 
+        frame = {"from": NODE_NAME, "message": txt}
+        if dl is not None:
+            # El nodo responde ACK:dl:<dl> para confirmar la entrega
+            frame["dl"] = dl
         try:
-            pkt = ujson.dumps({"from": NODE_NAME, "message": txt})
-            lora.send(pkt.encode()+b"\n")
+            _, st = lora.send(ujson.dumps(frame).encode()+b"\n")
             oled_log("TX LoRa: "+txt[:10])
         except Exception as e:
             oled_log(f"TX err: {str(e)[:10]}")
+            st = -1
+        if dl is not None:
+            if st == 0:
+                tx_pending = dl   # se confirma con TX_DONE en lora_callback
+            else:
+                report_status(dl, "failed")
 
     return _cb
 
@@ -278,7 +396,7 @@ PENDING_MAX = 200
 pending = []
 def pend_append(pkt):
     """
-    Añade un paquete al buffer de pendientes y elimina el más antiguo si se supera el límite.
+    Añade un paquete (bytes, o dict con traza) al buffer de pendientes y elimina el más antiguo si se supera el límite.
     :param pkt:
     :return:
     """
@@ -294,28 +412,77 @@ def pend_popleft():
 
 # ───────── 10. Main loop ─────────────────────────────────────────────────
 
+def annotate_uplink(pkt, rx, rssi, snr):
+    """
+    Añade al paquete la marca de recepción LoRa (``trace``) y los datos de
+    este puente (``gw``). Devuelve el JSON decodificado o, si no es JSON o no
+    hay nada que añadir, el paquete tal cual.
+    :param pkt: Bytes recibidos por LoRa
+    :param rx: Instante de recepción (ms desde 1970)
+    :param rssi: RSSI del paquete en dBm
+    :param snr: SNR del paquete en dB
+    :return:
+    """
+    if not (LATENCY_TRACE or GATEWAY_META or MQTT_BINARY):
+        return pkt
+    try:
+        js = ujson.loads(pkt)
+    except:
+        return pkt
+    if not isinstance(js, dict):
+        return pkt
+    if LATENCY_TRACE:
+        js["trace"] = {"rx": rx}
+    if GATEWAY_META:
+        js["gw"] = {"id": NODE_NAME, "rssi": rssi, "snr": snr}
+    return js
+
+def publish_up(up):
+    """
+    Publica un uplink en MQTT, anotando el instante de publicación si lleva
+    traza. Con ``MQTT_BINARY`` los uplinks JSON salen en sobre binario.
+    :param up: dict (JSON anotado) o bytes
+    :return:
+    """
+    if isinstance(up, dict):
+        pub = now_ms() if "trace" in up else None
+        if MQTT_BINARY:
+            data = pack_envelope(up, pub)
+        else:
+            if pub is not None:
+                up["trace"]["pub"] = pub
+            data = ujson.dumps(up)
+    else:
+        data = up
+    mqttc.publish(MQTT_TOPIC_UP, data, MQTT_RETAIN_UP, MQTT_QOS)
+
 def lora_callback(events):
     """
     Callback para recibir mensajes LoRa.
     :param events: Eventos LoRa
     :return:
     """
-    global mqttc, lora
+    global mqttc, lora, tx_pending
+    if events & SX1262.TX_DONE and tx_pending is not None:
+        report_status(tx_pending, "transmitted")
+        tx_pending = None
     if events & SX1262.RX_DONE:
+        rx = now_ms()
         try:
             pkt, st = lora.recv()
             if st == 0 and pkt:
+                up = annotate_uplink(pkt, rx, lora.getRSSI(), lora.getSNR())
                 try:
                     # Publicar en MQTT
-                    mqttc.publish(MQTT_TOPIC_UP, pkt, MQTT_RETAIN_UP, MQTT_QOS)
+                    publish_up(up)
                     try:
-                        js = ujson.loads(pkt)
+                        js = up if isinstance(up, dict) else ujson.loads(pkt)
                         oled_log("RX "+js.get("from","")[-6:]+":"+js.get("message","")[:8])
                     except:
                         oled_log("RX pkt: " + pkt.decode()[:10])
                 except Exception as e:
                     oled_log(f"Pub err: {str(e)[:10]}")
-                    pend_append(pkt)
+                    pend_append(up)
         except Exception as e:
             oled_log(f"RX err: {str(e)[:10]}")
 
@@ -347,6 +514,8 @@ def main():
         import machine
         machine.reset()
 
+    sync_clock()
+
     lora = init_lora()
     oled_log("LoRa OK")
 
@@ -354,6 +523,7 @@ def main():
 
     # Variables para control de tiempo
     last_ping_time = time.ticks_ms()
+    last_ntp_time = time.ticks_ms()
     start_time = time.time()
     ping_interval = 15000  # 15 segundos
     reset_interval = 86400  # 24 horas en segundos
@@ -391,6 +561,11 @@ def main():
         # Verificar si hay que apagar la pantalla
         check_screen_timeout(current_time)
 
+        # Resincronizar el reloj periódicamente
+        if LATENCY_TRACE and time.ticks_diff(current_time, last_ntp_time) > NTP_INTERVAL:
+            sync_clock()
+            last_ntp_time = current_time
+
         # Reinicio programado cada 24 horas
         if time.time() - start_time > reset_interval:
             oled_log("Reinicio programado")
@@ -410,12 +585,12 @@ def main():
 
             # Procesar mensajes pendientes
             if pending:
-                pkt = pend_popleft()
+                up = pend_popleft()
                 try:
-                    mqttc.publish(MQTT_TOPIC_UP, pkt, MQTT_RETAIN_UP, MQTT_QOS)
+                    publish_up(up)
                     oled_log(f"Sent pending ({len(pending)})")
                 except Exception as e:
-                    pend_append(pkt)
+                    pend_append(up)
                     oled_log(f"Pend err: {str(e)[:10]}")
                     # La biblioteca robusta manejará la reconexión
         except Exception as e:
@@ -195,12 +195,14 @@ def process_received_message():
             lcd_scroll(f"RX {rx_cnt}:{who}:{msg}")
             lcd_scroll(f"RSSI {rx_rssi:.1f} SNR {rx_snr:.1f}")
 
-            # Enviar ACK si es legal (respetando el ciclo de trabajo)
+            # Confirmar solo los mensajes de bajada del puente, que llevan su
+            # id (dl), y solo si es legal (respetando el ciclo de trabajo)
             now = time.ticks_ms()
             legal = time.ticks_diff(now, last_tx) > minimum_pause
 
-            if legal:
-                transmit(f"ACK:{rx_cnt}")
+            dl = rx_payload.get("dl")
+            if dl is not None and legal:
+                transmit(f"ACK:dl:{dl}")
 
             rx_cnt += 1
 